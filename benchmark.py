@@ -0,0 +1,256 @@
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+import ctypes
+import numpy as np
+from data_utils.parse_files import *
+from nn_utils.numpy_engine import NumpyLSTMModel, NumpyLSTMStepper
+import gen_utils.sequence_generator as sequence_generator
+from perf_utils.instrumentation import peak_rss_bytes, reset_peak_rss
+import argparse
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None # Python 2: peak memory comes from the resident set size instead, see peak_rss_growth
+
+# Benchmarks the preprocessing and generation hot paths on synthetic input, so no music library (and no Keras) is needed.
+# Each benchmark reports the median and best wall time over --repeat runs and the peak memory allocated during a run
+# (traced in a separate run so tracing doesn't slow down the timed ones). Under Python 3 the peak is taken with
+# tracemalloc; under Python 2 it is how far the peak resident set size grew during the run (see peak_rss_growth). Results are
+# written as JSON; with --baseline they are compared against an earlier run on the best times, which are the least
+# noisy, and the script exits with status 1 if any benchmark got slower than --tolerance allows.
+#
+# It also checks startup: every entry point's --help must finish within --startup-budget seconds, and importing the
+# data and generation modules must not load a deep learning framework. Either failing also gives exit status 1.
+# Startup times are too noisy to compare against a baseline, so they are only held to that absolute budget.
+
+# Entry points whose startup is timed, by running them with --help
+STARTUP_COMMANDS = ['convert_directory.py', 'generate.py', 'train.py', 'train_gan.py', 'sweep.py', 'generation_server.py', 'benchmark.py']
+# Modules that data-only and NumPy generation paths import; none of them may load a framework
+LIGHT_MODULES = ['data_utils.parse_files', 'data_utils.sharded_dataset', 'data_utils.conversion_cache', 'data_utils.batch_loader',
+                 'gen_utils.sequence_generator', 'gen_utils.generation_service', 'nn_utils.checkpoints', 'nn_utils.numpy_engine', 'generate']
+FRAMEWORK_MODULES = ('keras', 'tensorflow')
+
+# Writes a song of 'seconds' seconds of a few drifting sines plus noise as a 16-bit mono WAV
+def write_synthetic_wav(filename, seconds, sample_frequency=44100, seed=0):
+    random = np.random.RandomState(seed)
+    t = np.arange(int(seconds * sample_frequency)) / float(sample_frequency)
+    song = np.zeros(t.shape, dtype='float32')
+    for freq in random.uniform(55.0, 2000.0, size=4):
+        song += 0.15 * np.sin(2 * np.pi * freq * t * (1.0 + 0.01 * np.sin(t)))
+    song += 0.05 * random.randn(t.shape[0])
+    write_np_as_wav(np.clip(song, -1.0, 1.0), sample_frequency, filename)
+
+# Random weights for a NumpyLSTMModel; generation speed doesn't depend on what the model learned
+def random_numpy_model(num_frequency_dimensions, num_hidden_dimensions, seed=0):
+    random = np.random.RandomState(seed)
+    F, H = num_frequency_dimensions, num_hidden_dimensions
+    weights = {'recurrent_activation': 'hard_sigmoid',
+               'conv_in_kernel': random.randn(2, F, H) / np.sqrt(2 * F), 'conv_in_bias': np.zeros(H),
+               'lstm_kernel': random.randn(H, 4 * H) / np.sqrt(H), 'lstm_recurrent_kernel': random.randn(H, 4 * H) / np.sqrt(H), 'lstm_bias': np.zeros(4 * H),
+               'conv_out_kernel': random.randn(2, H, F) / np.sqrt(2 * H), 'conv_out_bias': np.zeros(F)}
+    return NumpyLSTMModel(weights)
+
+# Output of the benchmarked functions (conversion progress etc.) would drown the report
+class Silenced:
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+    def __exit__(self, *exc_info):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+# Peak memory of fn() where tracemalloc isn't available: fn is run in a forked child, and the growth of the child's peak
+# resident set size (ru_maxrss) over its resident set size at the start is reported, in bytes. The child inherits the
+# parent's peak, so on Linux it is first reset to the current resident set size; elsewhere the figure only shows growth
+# beyond the parent's peak so far. Before that, memory the allocator kept from the parent's earlier runs is handed back
+# to the OS (glibc's malloc_trim), or fn would reuse those already resident pages and look smaller than it is. Page granularity makes this coarser than tracemalloc. Returns None where fork or
+# getrusage are missing.
+def peak_rss_growth(fn):
+    if peak_rss_bytes() is None or not hasattr(os, 'fork'):
+        return None
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(read_fd)
+            try:
+                ctypes.CDLL(None).malloc_trim(0)
+            except (AttributeError, OSError):
+                pass # Not glibc
+            reset_peak_rss()
+            before = peak_rss_bytes()
+            with Silenced():
+                fn()
+            os.write(write_fd, str(peak_rss_bytes() - before).encode('ascii'))
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as f:
+        output = f.read()
+    pid, status = os.waitpid(pid, 0)
+    if status != 0 or not output:
+        return None
+    return int(output)
+
+# Runs fn() 'repeat' times for timing, plus once more for its peak memory (under tracemalloc, or see peak_rss_growth).
+# items is the number of items (blocks, samples, ...) fn processes, for the throughput figure.
+def measure(fn, repeat, items=None):
+    times = []
+    for i in range(repeat):
+        with Silenced():
+            start = time.time()
+            fn()
+            times.append(time.time() - start)
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            with Silenced():
+                fn()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    else:
+        peak = peak_rss_growth(fn)
+    result = {'seconds_median': float(np.median(times)), 'seconds_best': float(np.min(times)), 'peak_bytes': peak, 'repeat': repeat}
+    if items is not None:
+        result['items_per_second'] = items / max(result['seconds_median'], 1.0e-9)
+    return result
+
+def run_benchmarks(args, work_directory):
+    block_size = args.block_size
+    results = {}
+    wave_directory = os.path.join(work_directory, 'wave') + '/'
+    os.makedirs(wave_directory)
+    for i in range(args.songs):
+        write_synthetic_wav(wave_directory + 'song{0}.wav'.format(i), args.seconds, seed=i)
+    song, sample_rate = read_wav_as_np(wave_directory + 'song0.wav')
+
+    print('Benchmarking preprocessing...')
+    results['convert_np_audio_to_sample_blocks'] = measure(lambda: convert_np_audio_to_sample_blocks(song, block_size), args.repeat, items=song.shape[0])
+    time_blocks = convert_np_audio_to_sample_blocks(song, block_size)
+    results['time_blocks_to_fft_blocks'] = measure(lambda: time_blocks_to_fft_blocks(time_blocks), args.repeat, items=len(time_blocks))
+    fft_blocks = time_blocks_to_fft_blocks(time_blocks)
+    results['fft_blocks_to_time_blocks'] = measure(lambda: fft_blocks_to_time_blocks(fft_blocks), args.repeat, items=len(fft_blocks))
+    max_seq_len = args.max_seq_len
+    num_blocks = args.songs * len(time_blocks)
+    results['convert_wav_files_to_nptensor'] = measure(lambda: convert_wav_files_to_nptensor(wave_directory, block_size, max_seq_len, os.path.join(work_directory, 'dataset'), validation_split=0.2), args.repeat, items=num_blocks)
+
+    print('Benchmarking generation...')
+    num_dims = feature_dimensions(block_size)
+    model = random_numpy_model(num_dims, args.hidden_dims)
+    seed = np.random.RandomState(0).randn(1, max_seq_len, num_dims).astype('float32')
+    for seq_len in args.gen_lengths:
+        results['generate_from_seed/{0}'.format(seq_len)] = measure(lambda: sequence_generator.generate_from_seed(model, seed, seq_len), args.repeat, items=seq_len)
+        results['generate_from_seed_incremental/{0}'.format(seq_len)] = measure(lambda: sequence_generator.generate_from_seed_incremental(NumpyLSTMStepper(model), seed, seq_len), args.repeat, items=seq_len)
+    generated = fft_blocks[:max_seq_len]
+    out_filename = os.path.join(work_directory, 'generated.wav')
+    results['save_generated_example'] = measure(lambda: save_generated_example(out_filename, generated, sample_frequency=sample_rate), args.repeat, items=len(generated))
+    return results
+
+# Times each entry point's --help in a fresh interpreter. Returns (results, problems).
+def run_startup_benchmarks(repeat, budget):
+    directory = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    problems = []
+    for command in STARTUP_COMMANDS:
+        times = []
+        for i in range(repeat):
+            start = time.time()
+            with open(os.devnull, 'w') as devnull:
+                returncode = subprocess.call([sys.executable, command, '--help'], cwd=directory, stdout=devnull, stderr=devnull)
+            times.append(time.time() - start)
+            if returncode != 0:
+                problems.append('{0} --help failed'.format(command))
+                break
+        results['startup/' + command] = {'seconds_median': float(np.median(times)), 'seconds_best': float(np.min(times)), 'repeat': len(times)}
+        if min(times) > budget:
+            problems.append('{0} --help took {1:.2f} s (budget {2:.2f} s)'.format(command, min(times), budget))
+    for module in LIGHT_MODULES:
+        code = 'import sys, time; start = time.time(); import {0}; print(time.time() - start); print(",".join(m for m in {1!r} if m in sys.modules))'.format(module, FRAMEWORK_MODULES)
+        try:
+            output = subprocess.check_output([sys.executable, '-c', code], cwd=directory, stderr=subprocess.STDOUT).decode('utf-8').split('\n')
+        except subprocess.CalledProcessError as e:
+            problems.append('importing {0} failed: {1}'.format(module, e.output.decode('utf-8').strip().split('\n')[-1]))
+            continue
+        seconds = float(output[0])
+        results['import/' + module] = {'seconds_median': seconds, 'seconds_best': seconds, 'repeat': 1}
+        if output[1].strip():
+            problems.append('importing {0} loads {1}'.format(module, output[1].strip()))
+    return results, problems
+
+# Compares results against a baseline run. Returns the names of the benchmarks that got slower than 'tolerance' allows.
+def compare_results(results, baseline, tolerance):
+    regressions = []
+    print('{0:<45} {1:>12} {2:>12} {3:>8}'.format('benchmark', 'baseline s', 'current s', 'ratio'))
+    for name in sorted(results):
+        if name not in baseline:
+            print('{0:<45} {1:>12} {2:>12.4f}'.format(name, '-', results[name]['seconds_best']))
+            continue
+        ratio = results[name]['seconds_best'] / max(baseline[name]['seconds_best'], 1.0e-9)
+        flag = ''
+        if ratio > 1.0 + tolerance:
+            regressions.append(name)
+            flag = ' REGRESSION'
+        print('{0:<45} {1:>12.4f} {2:>12.4f} {3:>8.2f}{4}'.format(name, baseline[name]['seconds_best'], results[name]['seconds_best'], ratio, flag))
+    return regressions
+
+def __main__():
+    parser = argparse.ArgumentParser(description="Benchmark preprocessing and generation on synthetic audio.")
+    parser.add_argument("-o", "--output", default='benchmark.json', type=str, help="File to write the results to. Defaults to benchmark.json.")
+    parser.add_argument("--baseline", default=None, type=str, help="Results of an earlier run to compare against.")
+    parser.add_argument("--tolerance", default=0.1, type=float, help="Allowed slowdown against the baseline before a benchmark counts as a regression. Defaults to 0.1 (10%%).")
+    parser.add_argument("--repeat", default=3, type=int, help="Number of timed runs per benchmark.")
+    parser.add_argument("--songs", default=2, type=int, help="Number of synthetic songs to convert.")
+    parser.add_argument("--seconds", default=30.0, type=float, help="Length of each synthetic song in seconds.")
+    parser.add_argument("--block-size", default=11025, type=int, help="Block size in samples. Defaults to a quarter second, as used by convert_directory.py.")
+    parser.add_argument("--max-seq-len", default=10, type=int, help="Training example length in blocks, also used as the generation seed length.")
+    parser.add_argument("--hidden-dims", default=256, type=int, help="Hidden dimensions of the randomly initialized generation model.")
+    parser.add_argument("--gen-lengths", default=[10, 20, 40], type=int, nargs='+', help="Generated sequence lengths to benchmark.")
+    parser.add_argument("--startup-budget", default=1.0, type=float, help="Maximum seconds an entry point's --help may take. Defaults to 1.")
+    args = parser.parse_args()
+
+    work_directory = tempfile.mkdtemp(prefix='nugruv_benchmark_')
+    try:
+        results = run_benchmarks(args, work_directory)
+    finally:
+        shutil.rmtree(work_directory)
+    print('Benchmarking startup...')
+    startup_results, startup_problems = run_startup_benchmarks(args.repeat, args.startup_budget)
+    report = {'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform()},
+              'parameters': vars(args), 'results': results, 'startup': startup_results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('Results written to {0}'.format(args.output))
+
+    failed = False
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline['results'], args.tolerance)
+        if len(regressions) > 0:
+            print('{0} benchmark(s) regressed beyond {1:.0%}: {2}'.format(len(regressions), args.tolerance, ', '.join(regressions)))
+            failed = True
+    else:
+        for name in sorted(results):
+            peak_bytes = results[name]['peak_bytes']
+            print('{0:<45} {1:>10.4f} s {2:>12} bytes'.format(name, results[name]['seconds_median'], '-' if peak_bytes is None else peak_bytes))
+    for name in sorted(startup_results):
+        print('{0:<45} {1:>10.4f} s'.format(name, startup_results[name]['seconds_best']))
+    for problem in startup_problems:
+        print('Startup check failed: ' + problem)
+        failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    __main__()
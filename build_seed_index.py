@@ -0,0 +1,19 @@
+from __future__ import print_function
+from data_utils.sharded_dataset import load_dataset
+from gen_utils.seed_index import build_seed_index, seed_index_filename
+import config.nn_config as nn_config
+import argparse
+
+# Builds the seed index used by generate.py --seed-mode ahead of time (generate.py otherwise builds it on first use)
+config = nn_config.get_neural_net_configuration()
+parser = argparse.ArgumentParser(description="Build the seed index of a dataset for similarity-based seed selection.")
+parser.add_argument("--dataset", default='train', type=str, help='The dataset to index. Defaults to "train".')
+parser.add_argument("--bands", default=64, type=int, help="Number of frequency bands the pooled spectra are reduced to.")
+args = parser.parse_args()
+
+inputFile = config['model_file'] if args.dataset == 'train' else config['gen_file']
+X_train, y_train = load_dataset(inputFile)
+print('Indexing {0} examples of {1}'.format(X_train.shape[0], inputFile))
+index = build_seed_index(X_train, args.bands)
+index.save(seed_index_filename(inputFile))
+print('Seed index written to {0}'.format(seed_index_filename(inputFile)))
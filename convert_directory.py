@@ -1,13 +1,25 @@
 from data_utils.parse_files import *
+from data_utils.conversion_cache import convert_directory_cached
+from data_utils.sharded_dataset import convert_tracks_to_sharded_dataset
 import config.nn_config as nn_config
+import perf_utils.instrumentation as instrumentation
 
 import argparse
 
 parser = argparse.ArgumentParser(description="Convert MP3 files to WAV and prepare training data.")
 parser.add_argument("--dataset", default='train', type=str, help="Dataset to produce.")
 parser.add_argument("-v", "--validation", default=0.2, type=float, help="Validation split. Defaults to 0.2")
+parser.add_argument("--feature-format", default='fft', choices=FEATURE_FORMATS, help="Frequency domain feature format. 'rfft' stores only the non-redundant half of the spectrum, halving the feature dimensions. Defaults to 'fft'.")
+parser.add_argument("-j", "--workers", default=0, type=int, help="Number of files to decode in parallel. Defaults to the number of CPUs.")
+parser.add_argument("--sharded", action='store_true', default=False, help="Write the dataset as per-track shards plus a small index instead of monolithic .npy files.")
+parser.add_argument("--blocks", action='store_true', default=False, help="With --sharded, store each song's block sequence once and derive the overlapping x/y windows from it when training, instead of storing every window twice.")
+parser.add_argument("--dtype", default='float32', choices=STORAGE_DTYPES, help="Element type the training data is stored in. 'float16' halves its size on disk and in memory; it is converted back to float32 when read. Defaults to 'float32'.")
+parser.add_argument("--hop", default=0, type=int, help="Number of blocks between the starts of consecutive training windows. Defaults to half the window length (50%% overlap).")
+parser.add_argument("--no-cache", action='store_true', default=False, help="Re-decode and re-transform every file instead of re-using results cached from previous runs.")
 parser.add_argument("--skip-conv", action='store_true', default=False, help="Skip conversion to WAV and just generate data. This assumes the WAV files are already present.")
+instrumentation.add_arguments(parser)
 args = parser.parse_args()
+instrumentation.setup(args)
 
 config = nn_config.get_neural_net_configuration()
 
@@ -24,10 +36,24 @@ freq = config['sampling_frequency'] #sample frequency in Hz
 clip_len = 10 		#length of clips for training. Defined in seconds
 block_size = freq / 4 #block sizes used for training - this defines the size of our input state
 max_seq_len = int(round((freq * clip_len) / block_size)) #Used later for zero-padding song sequences
-#Step 1 - convert MP3s to WAVs
-if not args.skip_conv:
-    new_directory = convert_folder_to_wav(input_directory, freq)
+hop = args.hop if args.hop > 0 else None #Distance between training windows, in blocks
+if not args.no_cache:
+    #Only decode and transform new or changed files, re-using cached results for the rest
+    convert_directory_cached(input_directory, freq, block_size, max_seq_len, output_filename, validation_split=args.validation, feature_format=args.feature_format, num_workers=args.workers, skip_conv=args.skip_conv, sharded=args.sharded, store_blocks=args.blocks, hop=hop, dtype=args.dtype)
 else:
-    new_directory = input_directory + 'wave' + '/'
-#Step 2 - convert WAVs to frequency domain with mean 0 and standard deviation of 1
-convert_wav_files_to_nptensor(new_directory, block_size, max_seq_len, output_filename, validation_split=args.validation)
+    #Step 1 - convert MP3s to WAVs
+    if not args.skip_conv:
+        new_directory = convert_folder_to_wav(input_directory, freq, num_workers=args.workers)
+    else:
+        new_directory = input_directory + 'wave' + '/'
+    #Step 2 - convert WAVs to frequency domain with mean 0 and standard deviation of 1
+    if args.sharded:
+        tracks = []
+        for file in sorted(os.listdir(new_directory)):
+            if file.endswith('.wav'):
+                filename = new_directory+file
+                tracks.append((filename, count_wav_blocks(filename, block_size), lambda filename=filename: load_track_features(filename, block_size, feature_format=args.feature_format)))
+        convert_tracks_to_sharded_dataset(tracks, block_size, max_seq_len, output_filename, validation_split=args.validation, feature_format=args.feature_format, store_blocks=args.blocks, hop=hop, dtype=args.dtype)
+    else:
+        convert_wav_files_to_nptensor(new_directory, block_size, max_seq_len, output_filename, validation_split=args.validation, feature_format=args.feature_format, hop=hop, dtype=args.dtype)
+instrumentation.finish()
@@ -0,0 +1,88 @@
+import numpy as np
+
+# Serves shuffled mini-batches from (possibly memory-mapped or sharded) x/y arrays, so the dataset never has to fit in RAM.
+# Follows the keras.utils.Sequence protocol (__len__, __getitem__, on_epoch_end); wrap it in network_utils.LoaderSequence
+# to train on it with model.fit_generator. This module doesn't import Keras itself, so data tools can use it without it.
+# If indices is given, only those examples are served. If y is None, batches are just x.
+class BatchLoader:
+    def __init__(self, x, y, batch_size, shuffle=True, seed=None, indices=None):
+        assert y is None or len(x) == len(y)
+        self.x = x
+        self.y = y
+        self.batch_size = max(int(batch_size), 1)
+        self.shuffle = shuffle
+        self.random = np.random.RandomState(seed)
+        self.order = np.arange(len(x)) if indices is None else np.array(indices, dtype='int64')
+        self.on_epoch_end()
+
+    def __len__(self):
+        return (len(self.order) + self.batch_size - 1) // self.batch_size
+
+    def __getitem__(self, idx):
+        # Reading the examples of a batch in file order is friendlier to the page cache; their order within the batch doesn't matter
+        indices = np.sort(self.order[idx*self.batch_size:(idx+1)*self.batch_size])
+        if self.y is None:
+            return self.x[indices]
+        return self.x[indices], self.y[indices]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.random.shuffle(self.order)
+
+# Groups sequences of the given lengths into batches of similar length. Sequences are taken in order of length and
+# a batch is closed when adding the next one would exceed batch_size sequences, max_timesteps padded timesteps
+# (batch size times longest sequence, if set), or make more than max_padding of the batch's timesteps padding.
+# A sequence longer than max_timesteps gets a batch of its own. Returns a list of index arrays.
+def bucket_batches(lengths, batch_size, max_padding=0.1, max_timesteps=None):
+    batches = []
+    batch = []
+    total = 0
+    for idx in np.argsort(lengths, kind='mergesort'):
+        longest = int(lengths[idx]) # Sorted, so the newest sequence is always the longest
+        padded = (len(batch) + 1) * longest
+        if len(batch) > 0 and (len(batch) + 1 > batch_size or (max_timesteps and padded > max_timesteps) or padded - (total + longest) > max_padding * padded):
+            batches.append(np.array(batch, dtype='int64'))
+            batch = []
+            total = 0
+        batch.append(idx)
+        total += longest
+    if len(batch) > 0:
+        batches.append(np.array(batch, dtype='int64'))
+    return batches
+
+# Serves batches of variable-length sequences (e.g. data_utils.sharded_dataset.SequenceDataset), bucketed by length
+# with bucket_batches. Each batch is (x, y, sample_weight): x and y are zero-padded at the end to the longest sequence
+# in the batch, and sample_weight is a (batch, timesteps) mask that is 0 on padding, for models compiled with
+# sample_weight_mode='temporal'. The batches are fixed; their order is shuffled every epoch.
+# Follows the same protocol as BatchLoader, so it can be wrapped in network_utils.LoaderSequence the same way.
+class BucketBatchLoader:
+    def __init__(self, dataset, batch_size, max_padding=0.1, max_timesteps=None, shuffle=True, seed=None):
+        self.dataset = dataset
+        self.batches = bucket_batches(dataset.lengths, max(int(batch_size), 1), max_padding, max_timesteps)
+        self.shuffle = shuffle
+        self.random = np.random.RandomState(seed)
+        self.order = np.arange(len(self.batches))
+        self.on_epoch_end()
+
+    def __len__(self):
+        return len(self.batches)
+
+    # Fraction of the timesteps served per epoch that are padding
+    def padding_fraction(self):
+        padded = sum(len(batch) * self.dataset.lengths[batch].max() for batch in self.batches)
+        return 1.0 - float(self.dataset.lengths.sum()) / max(padded, 1)
+
+    def __getitem__(self, idx):
+        batch = self.batches[self.order[idx]]
+        lengths = self.dataset.lengths[batch]
+        x = np.zeros((len(batch), lengths.max(), self.dataset.num_dims), dtype='float32')
+        y = np.zeros(x.shape, dtype='float32')
+        sample_weight = np.zeros(x.shape[:2], dtype='float32')
+        for i in range(len(batch)):
+            x[i,:lengths[i]], y[i,:lengths[i]] = self.dataset[batch[i]]
+            sample_weight[i,:lengths[i]] = 1.0
+        return x, y, sample_weight
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.random.shuffle(self.order)
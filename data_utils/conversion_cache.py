@@ -0,0 +1,138 @@
+import os
+import json
+import hashlib
+import numpy as np
+from data_utils.parse_files import *
+from data_utils.sharded_dataset import convert_tracks_to_sharded_dataset
+
+# Bump when the cached feature layout changes, to invalidate existing caches
+CACHE_VERSION = 1
+
+# SHA-1 of a file's contents, read in chunks
+def hash_file(filename, chunk_size=1 << 20):
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        chunk = f.read(chunk_size)
+        while chunk:
+            sha.update(chunk)
+            chunk = f.read(chunk_size)
+    return sha.hexdigest()
+
+# Key for a source file converted with the given parameters
+def make_cache_key(source_hash, params):
+    sha = hashlib.sha1()
+    sha.update(source_hash.encode('utf-8'))
+    sha.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    return sha.hexdigest()
+
+# Manifest-backed cache of decoded WAVs and per-track feature shards.
+# Each source file is identified by the hash of its contents; size and modification time are remembered so
+# that unchanged files don't have to be re-hashed. The manifest lives in <cache_directory>/manifest.json.
+class ConversionCache:
+    def __init__(self, cache_directory):
+        self.cache_directory = cache_directory
+        self.manifest_filename = os.path.join(cache_directory, 'manifest.json')
+        self.sources = {}
+        if not os.path.isdir(cache_directory):
+            os.makedirs(cache_directory)
+        if os.path.isfile(self.manifest_filename):
+            with open(self.manifest_filename) as f:
+                manifest = json.load(f)
+            if manifest.get('version') == CACHE_VERSION:
+                self.sources = manifest['sources']
+
+    def entry(self, filename):
+        return self.sources.setdefault(filename, {})
+
+    # Content hash of a source file, re-using the stored hash if the file's size and modification time are unchanged
+    def source_hash(self, filename):
+        entry = self.entry(filename)
+        stat = os.stat(filename)
+        if entry.get('size') != stat.st_size or entry.get('mtime') != stat.st_mtime or 'hash' not in entry:
+            entry.clear()
+            entry['size'] = stat.st_size
+            entry['mtime'] = stat.st_mtime
+            entry['hash'] = hash_file(filename)
+        return entry['hash']
+
+    def feature_filename(self, key):
+        return os.path.join(self.cache_directory, key + '.npy')
+
+    # Loads the cached feature shard for key, computing and storing it with compute() if it doesn't exist yet.
+    # Returns the shard as a read-only memory map.
+    def features(self, key, compute):
+        filename = self.feature_filename(key)
+        if not os.path.isfile(filename):
+            tmp_filename = filename + '.tmp.npy'
+            np.save(tmp_filename, compute().astype('float32'))
+            os.rename(tmp_filename, filename) # Atomic, so an interrupted run never leaves a truncated shard behind
+        return np.load(filename, mmap_mode='r')
+
+    # Forgets sources that no longer exist and deletes feature shards that are no longer referenced
+    def prune(self, sources, feature_keys):
+        self.sources = dict((filename, entry) for filename, entry in self.sources.items() if filename in sources)
+        keep = set(key + '.npy' for key in feature_keys)
+        for file in os.listdir(self.cache_directory):
+            if file.endswith('.npy') and file not in keep:
+                os.remove(os.path.join(self.cache_directory, file))
+
+    def save(self):
+        tmp_filename = self.manifest_filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'sources': self.sources}, f, indent=2, sort_keys=True)
+        os.rename(tmp_filename, self.manifest_filename)
+
+# Incremental version of convert_folder_to_wav + convert_wav_files_to_nptensor.
+# Only sources whose contents changed since the last run are decoded, and only tracks whose contents or conversion
+# parameters changed are re-transformed; all other tracks are read back from their cached feature shards.
+# If skip_conv is set, the WAVs already present in the 'wave' folder are used as the sources instead.
+# If sharded is set, the output is written in the sharded format (see sharded_dataset.py), using the 'blocks' layout if store_blocks is set.
+def convert_directory_cached(input_directory, sample_rate, block_size, max_seq_len, out_file, validation_split=0.0, useTimeDomain=False, feature_format='fft', num_workers=None, skip_conv=False, sharded=False, store_blocks=False, hop=None, dtype='float32'):
+    cache = ConversionCache(input_directory + 'cache/')
+    wave_directory = input_directory + 'wave/'
+    # The shards only depend on how each song is cut into blocks and transformed; the clip length only affects
+    # how windows are taken from the shards, which is redone on every run
+    feature_params = {'sample_rate': int(sample_rate), 'block_size': int(block_size), 'useTimeDomain': useTimeDomain, 'feature_format': feature_format}
+
+    #Step 1 - decode new or changed sources
+    wav_sources = []
+    if skip_conv:
+        for file in sorted(os.listdir(wave_directory)):
+            if file.endswith('.wav'):
+                wav_sources.append((wave_directory+file, wave_directory+file))
+    else:
+        to_decode = []
+        for filename in list_source_audio_files(input_directory):
+            ext = filename[filename.rindex('.'):]
+            wav_filename = wav_output_filename(filename, ext)
+            decode_key = make_cache_key(cache.source_hash(filename), {'sample_rate': int(sample_rate)})
+            if cache.entry(filename).get('decoded') != decode_key or not os.path.isfile(wav_filename):
+                to_decode.append(filename)
+            wav_sources.append((filename, wav_filename))
+        print('Decoding {0} new or changed files ({1} cached)'.format(len(to_decode), len(wav_sources) - len(to_decode)))
+        failed = set(convert_files_to_wav(to_decode, sample_rate, num_workers))
+        for filename in to_decode:
+            if filename not in failed:
+                cache.entry(filename)['decoded'] = make_cache_key(cache.source_hash(filename), {'sample_rate': int(sample_rate)})
+        wav_sources = [(filename, wav_filename) for filename, wav_filename in wav_sources if filename not in failed]
+
+    #Step 2 - transform new or changed tracks into per-track feature shards
+    tracks = []
+    feature_keys = []
+    num_computed = 0
+    for filename, wav_filename in wav_sources:
+        key = make_cache_key(cache.source_hash(filename), feature_params)
+        feature_keys.append(key)
+        if not os.path.isfile(cache.feature_filename(key)):
+            num_computed += 1
+        features = cache.features(key, lambda: load_track_features(wav_filename, block_size, useTimeDomain=useTimeDomain, feature_format=feature_format))
+        tracks.append((filename, features.shape[0], lambda key=key: np.load(cache.feature_filename(key))))
+    print('Transformed {0} new or changed tracks ({1} cached)'.format(num_computed, len(tracks) - num_computed))
+    cache.prune(set(filename for filename, wav_filename in wav_sources), feature_keys)
+    cache.save()
+
+    #Step 3 - assemble the training tensors from the shards
+    if sharded:
+        convert_tracks_to_sharded_dataset(tracks, block_size, max_seq_len, out_file, validation_split, useTimeDomain, feature_format, store_blocks, hop, dtype)
+    else:
+        convert_tracks_to_nptensor(tracks, block_size, max_seq_len, out_file, validation_split, useTimeDomain, feature_format, hop, dtype)
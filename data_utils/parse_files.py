@@ -1,224 +1,487 @@
 import os
-import scipy.io.wavfile as wav
+import json
+import wave
 import numpy as np
-from pipes import quote
+import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from config import nn_config
+from data_utils.running_stats import RunningMoments
+from perf_utils.instrumentation import timer, count
 
-def convert_mp3_to_wav(filename, sample_frequency):
-    ext = filename[-4:]
-    if(ext != '.mp3'):
-        return
+# Supported frequency domain feature formats:
+# 'fft'  - real and imaginary halves of the full FFT, 2*block_size features per block
+# 'rfft' - packed real FFT, block_size features per block. The redundant conjugate-symmetric half is dropped,
+#          as are the imaginary parts of the DC (and, for even block sizes, Nyquist) bins, which are always zero
+FEATURE_FORMATS = ('fft', 'rfft')
+# Element types training tensors can be stored in. Features are always computed and normalized in float32;
+# float16 halves the size of the dataset on disk and in the page cache, and is upcast to float32 when read.
+STORAGE_DTYPES = ('float32', 'float16')
+# scipy.io takes longer to import than everything else here, so the WAV functions import it when first called
+
+# Returns the WAV filename a source file is converted to (in a 'wave' folder next to it), creating the folder if needed
+def wav_output_filename(filename, ext):
     files = filename.split('/')
-    orig_filename = files[-1][0:-4]
-    orig_path = filename[0:-len(files[-1])]
+    orig_filename = files[-1][0:-len(ext)]
     new_path = ''
     if(filename[0] == '/'):
         new_path = '/'
     for i in xrange(len(files)-1):
         new_path += files[i]+'/'
-    tmp_path = new_path + 'tmp'
     new_path += 'wave'
-    if not os.path.exists(new_path):
+    try:
         os.makedirs(new_path)
-    if not os.path.exists(tmp_path):
-        os.makedirs(tmp_path)
-    filename_tmp = tmp_path + '/' + orig_filename + '.mp3'
-    new_name = new_path + '/' + orig_filename + '.wav'
-    sample_freq_str = "{0:.1f}".format(float(sample_frequency)/1000.0)
-    cmd = 'lame -a -m m {0} {1}'.format(quote(filename), quote(filename_tmp))
-    os.system(cmd)
-    cmd = 'lame --decode {0} {1} --resample {2}'.format(quote(filename_tmp), quote(new_name), sample_freq_str)
-    os.system(cmd)
+    except OSError:
+        # Already exists (possibly created concurrently by another worker)
+        if not os.path.isdir(new_path):
+            raise
+    return new_path + '/' + orig_filename + '.wav'
+
+# Decodes, downmixes and resamples an MP3 in a single pass: lame decodes to a WAV stream that is piped straight
+# into sox, so no intermediate file is written. Raises a RuntimeError if either tool fails.
+def convert_mp3_to_wav(filename, sample_frequency):
+    ext = filename[-4:]
+    if(ext != '.mp3'):
+        return
+    new_name = wav_output_filename(filename, ext)
+    decoder = subprocess.Popen(['lame', '--quiet', '--decode', filename, '-'], stdout=subprocess.PIPE)
+    resampler = subprocess.Popen(['sox', '-q', '-t', 'wav', '-', '-b', '16', new_name, 'channels', '1', 'rate', str(sample_frequency)], stdin=decoder.stdout)
+    decoder.stdout.close() # Let lame receive SIGPIPE if sox exits early
+    resampler_code = resampler.wait()
+    decoder_code = decoder.wait()
+    if decoder_code != 0 or resampler_code != 0:
+        if os.path.isfile(new_name):
+            os.remove(new_name) # Don't leave a truncated WAV behind
+        raise RuntimeError('Failed to convert {0} (lame exit code {1}, sox exit code {2})'.format(filename, decoder_code, resampler_code))
     return new_name
 
 def convert_flac_to_wav(filename, sample_frequency):
     ext = filename[-5:]
     if(ext != '.flac'):
         return
-    files = filename.split('/')
-    orig_filename = files[-1][0:-5]
-    orig_path = filename[0:-len(files[-1])]
-    new_path = ''
-    if(filename[0] == '/'):
-        new_path = '/'
-    for i in xrange(len(files)-1):
-        new_path += files[i]+'/'
-    new_path += 'wave'
-    if not os.path.exists(new_path):
-        os.makedirs(new_path)
-    new_name = new_path + '/' + orig_filename + '.wav'
-    cmd = 'sox {0} {1} channels 1 rate {2}'.format(quote(filename), quote(new_name), sample_frequency)
-    os.system(cmd)
+    new_name = wav_output_filename(filename, ext)
+    code = subprocess.call(['sox', filename, new_name, 'channels', '1', 'rate', str(sample_frequency)])
+    if code != 0:
+        if os.path.isfile(new_name):
+            os.remove(new_name) # Don't leave a truncated WAV behind
+        raise RuntimeError('Failed to convert {0} (sox exit code {1})'.format(filename, code))
     return new_name
 
+# Converts a single MP3 or FLAC file. Returns (filename, error message or None) so failures can be reported from worker threads.
+def convert_audio_file_to_wav(task):
+    filename, sample_rate = task
+    try:
+        if filename.endswith('.mp3'):
+            convert_mp3_to_wav(filename=filename, sample_frequency=sample_rate)
+        elif filename.endswith('.flac'):
+            convert_flac_to_wav(filename=filename, sample_frequency=sample_rate)
+    except (RuntimeError, OSError) as e:
+        return filename, str(e)
+    return filename, None
+
+# Lists the MP3 and FLAC files in a directory
+def list_source_audio_files(directory):
+    files = []
+    for file in sorted(os.listdir(directory)):
+        if file.endswith('.mp3') or file.endswith('.flac'):
+            files.append(directory+file)
+    return files
 
-def convert_folder_to_wav(directory, sample_rate=44100):
-    for file in os.listdir(directory):
-        fullfilename = directory+file
-        if file.endswith('.mp3'):
-            convert_mp3_to_wav(filename=fullfilename, sample_frequency=sample_rate)
-        if file.endswith('.flac'):
-            convert_flac_to_wav(filename=fullfilename, sample_frequency=sample_rate)
+# Converts all MP3 and FLAC files in a directory to mono WAVs at the given sample rate.
+def convert_folder_to_wav(directory, sample_rate=44100, num_workers=None):
+    convert_files_to_wav(list_source_audio_files(directory), sample_rate, num_workers)
     return directory + 'wave/'
 
+# Converts the given MP3 and FLAC files to mono WAVs, returning the list of files that failed.
+# The decoding itself happens in lame/sox subprocesses, so num_workers threads are enough to keep that many cores busy.
+# num_workers defaults to the number of CPUs.
+def convert_files_to_wav(filenames, sample_rate=44100, num_workers=None):
+    tasks = [(filename, sample_rate) for filename in filenames]
+    if num_workers is None or num_workers < 1:
+        num_workers = multiprocessing.cpu_count()
+    failed = []
+    pool = ThreadPool(max(min(num_workers, len(tasks)), 1))
+    try:
+        with timer('convert.decode', items=len(tasks)):
+            for i, (filename, error) in enumerate(pool.imap_unordered(convert_audio_file_to_wav, tasks)):
+                if error is not None:
+                    failed.append(filename)
+                    count('convert.decode_failures')
+                    print('Failed {0}/{1}: {2}'.format(i+1, len(tasks), error))
+                else:
+                    print('Converted {0}/{1}: {2}'.format(i+1, len(tasks), filename))
+    finally:
+        pool.close()
+        pool.join()
+    if len(failed) > 0:
+        print('{0} of {1} files could not be converted'.format(len(failed), len(tasks)))
+    return failed
+
 def read_wav_as_np(filename):
-    data = wav.read(filename)
-    np_arr = data[1].astype('float32') / 32767.0 #Normalize 16-bit input to [-1, 1] range
+    import scipy.io.wavfile as wav
+    with timer('convert.read_wav') as t:
+        data = wav.read(filename)
+        np_arr = data[1].astype('float32') / 32767.0 #Normalize 16-bit input to [-1, 1] range
+        t.items = np_arr.shape[0]
     #np_arr = np.array(np_arr)
     return np_arr, data[0]
 
 def write_np_as_wav(X, sample_rate, filename):
+    import scipy.io.wavfile as wav
     Xnew = X * 32767.0
     Xnew = Xnew.astype('int16')
     wav.write(filename, sample_rate, Xnew)
     return
 
-def convert_np_audio_to_sample_blocks(song_np, block_size):
-    block_lists = []
+# Splits a song into a (num_blocks, block_size) matrix, zero-padding the final block
+def convert_np_audio_to_block_matrix(song_np, block_size):
+    block_size = int(block_size)
     total_samples = song_np.shape[0]
-    num_samples_so_far = 0
-    while(num_samples_so_far < total_samples):
-        block = song_np[num_samples_so_far:num_samples_so_far+block_size]
-        if(block.shape[0] < block_size):
-            padding = np.zeros((block_size - block.shape[0],))
-            block = np.concatenate((block, padding))
-        block_lists.append(block)
-        num_samples_so_far += block_size
-    return block_lists
+    num_blocks = (total_samples + block_size - 1) // block_size
+    padded = np.zeros((num_blocks * block_size,), dtype=song_np.dtype)
+    padded[:total_samples] = song_np
+    return padded.reshape((num_blocks, block_size))
+
+def convert_np_audio_to_sample_blocks(song_np, block_size):
+    return list(convert_np_audio_to_block_matrix(song_np, block_size))
 
 def convert_sample_blocks_to_np_audio(blocks):
     song_np = np.concatenate(blocks)
     return song_np
 
+# Converts a (num_blocks, block_size) matrix of time domain blocks to a (num_blocks, 2*block_size) matrix
+# holding the real and imaginary halves of each block's FFT. All blocks are transformed in one batched call.
+def time_block_matrix_to_fft_matrix(blocks_time_domain):
+    fft_blocks = np.fft.fft(blocks_time_domain, axis=1)
+    return np.concatenate((np.real(fft_blocks), np.imag(fft_blocks)), axis=1)
+
+# Inverse of time_block_matrix_to_fft_matrix. Only the real part of the inverse FFT is kept, since that is all that ends up in the WAV file.
+def fft_matrix_to_time_block_matrix(blocks_ft_domain):
+    assert blocks_ft_domain.shape[1] % 2 == 0
+    num_elems = blocks_ft_domain.shape[1] // 2
+    fft_blocks = blocks_ft_domain[:, 0:num_elems] + 1.0j * blocks_ft_domain[:, num_elems:]
+    return np.real(np.fft.ifft(fft_blocks, axis=1))
+
+# Converts a (num_blocks, block_size) matrix of time domain blocks to a (num_blocks, block_size) matrix in the packed 'rfft' format:
+# the real parts of all block_size/2+1 real FFT bins followed by the imaginary parts of the bins that can be non-zero.
+def time_block_matrix_to_rfft_matrix(blocks_time_domain):
+    block_size = blocks_time_domain.shape[1]
+    rfft_blocks = np.fft.rfft(blocks_time_domain, axis=1)
+    return np.concatenate((np.real(rfft_blocks), np.imag(rfft_blocks[:, 1:(block_size+1)//2])), axis=1)
+
+# Inverse of time_block_matrix_to_rfft_matrix
+def rfft_matrix_to_time_block_matrix(blocks_ft_domain):
+    block_size = blocks_ft_domain.shape[1]
+    num_bins = block_size // 2 + 1
+    rfft_blocks = blocks_ft_domain[:, 0:num_bins].astype('complex128')
+    rfft_blocks[:, 1:(block_size+1)//2] += 1.0j * blocks_ft_domain[:, num_bins:]
+    return np.fft.irfft(rfft_blocks, n=block_size, axis=1)
+
+# Number of features per block for the given block size and feature format
+def feature_dimensions(block_size, feature_format='fft'):
+    assert feature_format in FEATURE_FORMATS
+    if feature_format == 'rfft':
+        return int(block_size)
+    return 2 * int(block_size)
+
+def time_block_matrix_to_features(blocks_time_domain, feature_format='fft'):
+    assert feature_format in FEATURE_FORMATS
+    if feature_format == 'rfft':
+        return time_block_matrix_to_rfft_matrix(blocks_time_domain)
+    return time_block_matrix_to_fft_matrix(blocks_time_domain)
+
+def features_to_time_block_matrix(blocks_ft_domain, feature_format='fft'):
+    assert feature_format in FEATURE_FORMATS
+    if feature_format == 'rfft':
+        return rfft_matrix_to_time_block_matrix(blocks_ft_domain)
+    return fft_matrix_to_time_block_matrix(blocks_ft_domain)
+
 def time_blocks_to_fft_blocks(blocks_time_domain):
-    fft_blocks = []
-    for block in blocks_time_domain:
-        fft_block = np.fft.fft(block)
-        new_block = np.concatenate((np.real(fft_block), np.imag(fft_block)))
-        fft_blocks.append(new_block)
-    return fft_blocks	
+    if len(blocks_time_domain) == 0:
+        return []
+    return list(time_block_matrix_to_fft_matrix(np.asarray(blocks_time_domain)))
 
 def fft_blocks_to_time_blocks(blocks_ft_domain):
-    time_blocks = []
-    for block in blocks_ft_domain:
-        assert block.shape[0] % 2 == 0
-        num_elems = block.shape[0] / 2
-        real_chunk = block[0:num_elems]
-        imag_chunk = block[num_elems:]
-        new_block = real_chunk + 1.0j * imag_chunk
-        time_block = np.fft.ifft(new_block)
-        time_blocks.append(time_block)
-    return time_blocks
-
-def convert_wav_files_to_nptensor(directory, block_size, max_seq_len, out_file, validation_split=0.0, useTimeDomain=False):
-    files = []
-    for file in os.listdir(directory):
-        if file.endswith('.wav'):
-            files.append(directory+file)
-    chunks_X = []
-    chunks_Y = []
-    num_files = len(files)
-    for file_idx in xrange(num_files):
-        file = files[file_idx]
-        print('Processing: {0}/{1}'.format((file_idx+1), num_files))
-        print('Filename: {0}'.format(file))
-        X, Y = load_training_example(file, block_size, useTimeDomain=useTimeDomain)
-        assert all(b.shape == (2*block_size,) for b in X)
-        assert len(X) == len(Y)
-        cur_seq = 0
-        total_seq = len(X)
-        step_size = max_seq_len / 2 # Duplicate part of each clip to try and include more time-distributed information about each song.
-        while cur_seq + max_seq_len < total_seq:
-            chunks_X.append(X[cur_seq:cur_seq+max_seq_len])
-            chunks_Y.append(Y[cur_seq:cur_seq+max_seq_len])
-            cur_seq += step_size
-    num_examples = len(chunks_X)
+    if len(blocks_ft_domain) == 0:
+        return []
+    return list(fft_matrix_to_time_block_matrix(np.asarray(blocks_ft_domain)))
+
+# Dataset info (feature format, block size, ...) is stored next to the tensors so that consumers know how to interpret them
+def save_dataset_info(out_file, info):
+    with open(out_file + '_info.json', 'w') as f:
+        json.dump(info, f, indent=2, sort_keys=True)
+
+# Loads the dataset info saved by save_dataset_info. Datasets created before it existed use the 'fft' format.
+def load_dataset_info(out_file):
+    info = {'feature_format': 'fft', 'useTimeDomain': False}
+    if os.path.isfile(out_file + '_info.json'):
+        with open(out_file + '_info.json') as f:
+            info.update(json.load(f))
+    return info
+
+# Number of blocks a WAV file will be split into, read from the file header without decoding the song
+def count_wav_blocks(filename, block_size):
+    import scipy.io.wavfile as wav
+    sample_rate, data = wav.read(filename, mmap=True)
+    block_size = int(block_size)
+    return (data.shape[0] + block_size - 1) // block_size
+
+# Default hop between training windows: 50% overlap.
+# Duplicate part of each clip to try and include more time-distributed information about each song.
+def default_hop(max_seq_len):
+    return max(max_seq_len // 2, 1)
+
+# Number of training windows taken from a song of total_seq blocks: one every step_size blocks, as long as a whole
+# window and its target (shifted by one block) fit in the song
+def count_windows(total_seq, max_seq_len, step_size):
+    return (max(total_seq - max_seq_len, 0) + step_size - 1) // step_size
+
+# Zero-copy (num_windows, window_len, num_dims) view of the windows of a (num_blocks, num_dims) block matrix that start every hop blocks
+def strided_windows(blocks, window_len, hop, num_windows=None):
+    if num_windows is None:
+        num_windows = count_windows(blocks.shape[0], window_len, hop)
+    shape = (num_windows, window_len, blocks.shape[1])
+    strides = (hop * blocks.strides[0], blocks.strides[0], blocks.strides[1])
+    return np.lib.stride_tricks.as_strided(blocks, shape=shape, strides=strides, writeable=False)
+
+# Number of validation examples and the stride at which they are taken from the sequence of all examples
+def validation_split_params(num_examples, validation_split):
     num_val = int(round(validation_split*num_examples))
-    num_train = num_examples - num_val
-    num_dims_out = block_size * 2
-    if(useTimeDomain):
-        num_dims_out = block_size
-    train_shape = (num_train, max_seq_len, num_dims_out)
-    val_shape = (num_val, max_seq_len, num_dims_out)
-    x_data = np.zeros(train_shape)
-    y_data = np.zeros(train_shape)
     if num_val > 0:
         val_step = int(round(num_examples / float(num_val)))
-        x_val = np.zeros(val_shape)
-        y_val = np.zeros(val_shape)
+        # Rounding the stride up can leave fewer than num_val multiples of it below num_examples; shrink it so they all fit
+        val_step = max(min(val_step, (num_examples - 1) // max(num_val - 1, 1)), 1)
     else:
         # Don't use validation set
         val_step = -1
-    for n in xrange(num_examples):
-        for i in xrange(max_seq_len):
-            if num_val > 0 and n % val_step == 0:
-                idx = n / val_step
-                x_val[idx][i] = chunks_X[n][i]
-                y_val[idx][i] = chunks_Y[n][i]
-                continue
-            elif num_val > 0:
-                idx = n - n / val_step - 1
-            else:
-                idx = n
-            x_data[idx][i] = chunks_X[n][i]
-            y_data[idx][i] = chunks_Y[n][i]
-        print('Saved example {0}/{1}'.format((n+1), num_examples))
-    print('Flushing to disk...')
-    assert x_data.shape[0] != len(chunks_X)
-    assert y_data.shape[0] != len(chunks_Y)
-    mean_x = np.mean(np.mean(x_data, axis=0), axis=0) #Mean across num examples and num timesteps
-    std_x = np.sqrt(np.mean(np.mean(np.abs(x_data-mean_x)**2, axis=0), axis=0)) # STD across num examples and num timesteps
+    return num_val, val_step
+
+# Maps the n-th example overall to (is_validation, index within its split). Every val_step-th example goes to the
+# validation set, up to num_val of them; the training index skips the validation examples before n.
+def split_example_index(n, num_val, val_step):
+    if num_val == 0:
+        return False, n
+    if n % val_step == 0 and n // val_step < num_val:
+        return True, n // val_step
+    num_val_before = min((n + val_step - 1) // val_step, num_val)
+    return False, n - num_val_before
+
+# Indices of the training and validation examples of num_examples examples split the same way as by the converters
+def split_indices(num_examples, validation_split):
+    num_val, val_step = validation_split_params(num_examples, validation_split)
+    is_val = np.array([split_example_index(n, num_val, val_step)[0] for n in xrange(num_examples)], dtype=bool)
+    return np.flatnonzero(~is_val), np.flatnonzero(is_val)
+
+# Normalizes a tensor in place, chunk_size examples at a time. Reduced precision tensors are normalized in float32.
+def normalize_tensor_in_place(tensor, mean_x, std_x, chunk_size=16):
+    with timer('convert.normalize', items=tensor.shape[0]):
+        for start in xrange(0, tensor.shape[0], chunk_size):
+            chunk = tensor[start:start+chunk_size].astype('float32')
+            chunk -= mean_x #Mean 0
+            chunk /= std_x #Variance 1
+            tensor[start:start+chunk_size] = chunk
+
+# Checks that un-normalized features of the given block size fit in the storage dtype.
+# Time domain samples are within [-1, 1] and frequency domain features within [-block_size, block_size].
+def check_storage_dtype(dtype, block_size, useTimeDomain=False):
+    assert dtype in STORAGE_DTYPES
+    max_value = 1.0 if useTimeDomain else float(block_size)
+    if max_value > float(np.finfo(dtype).max):
+        raise ValueError('Features of blocks of {0} samples can exceed the range of {1}'.format(int(block_size), dtype))
+
+# Converts all WAVs in a directory into training tensors, streaming them straight into memory-mapped .npy files.
+def convert_wav_files_to_nptensor(directory, block_size, max_seq_len, out_file, validation_split=0.0, useTimeDomain=False, feature_format='fft', hop=None, dtype='float32'):
+    tracks = []
+    for file in sorted(os.listdir(directory)):
+        if file.endswith('.wav'):
+            filename = directory+file
+            loader = lambda filename=filename: load_track_features(filename, block_size, useTimeDomain=useTimeDomain, feature_format=feature_format)
+            tracks.append((filename, count_wav_blocks(filename, block_size), loader))
+    convert_tracks_to_nptensor(tracks, block_size, max_seq_len, out_file, validation_split, useTimeDomain, feature_format, hop, dtype)
+
+# Writes training tensors for a list of (name, num_blocks, loader) tracks, where loader() returns the track's
+# (num_blocks, num_dims) feature matrix (see load_track_features).
+# A window of max_seq_len blocks is taken every hop blocks (default_hop if None). The windows are zero-copy strided
+# views into each song's block matrix; they are only materialized when written to the output files.
+# The first pass only uses the block counts to size the output files, the second loads one track at a time,
+# so peak memory is bounded by a single song regardless of the size of the library.
+# Normalization statistics are accumulated while the songs are converted and saved to <out_file>_stats.npz as well,
+# so they can be merged with statistics from other conversions.
+# The tensors are stored as dtype (see STORAGE_DTYPES).
+def convert_tracks_to_nptensor(tracks, block_size, max_seq_len, out_file, validation_split=0.0, useTimeDomain=False, feature_format='fft', hop=None, dtype='float32'):
+    check_storage_dtype(dtype, block_size, useTimeDomain)
+    num_files = len(tracks)
+    if hop is None:
+        hop = default_hop(max_seq_len)
+    num_examples = 0
+    for name, num_blocks, loader in tracks:
+        num_examples += count_windows(num_blocks, max_seq_len, hop)
+    num_val, val_step = validation_split_params(num_examples, validation_split)
+    num_train = num_examples - num_val
+    num_dims_out = feature_dimensions(block_size, feature_format)
+    if(useTimeDomain):
+        num_dims_out = int(block_size)
+    train_shape = (num_train, max_seq_len, num_dims_out)
+    val_shape = (num_val, max_seq_len, num_dims_out)
+    if os.path.isfile(out_file+'_index.json'):
+        os.remove(out_file+'_index.json') # Otherwise consumers would keep reading a previous sharded conversion
+    x_data = np.lib.format.open_memmap(out_file+'_x.npy', mode='w+', dtype=dtype, shape=train_shape)
+    y_data = np.lib.format.open_memmap(out_file+'_y.npy', mode='w+', dtype=dtype, shape=train_shape)
+    if num_val > 0:
+        x_val = np.lib.format.open_memmap(out_file+'_val_x.npy', mode='w+', dtype=dtype, shape=val_shape)
+        y_val = np.lib.format.open_memmap(out_file+'_val_y.npy', mode='w+', dtype=dtype, shape=val_shape)
+    moments = RunningMoments(num_dims_out)
+    val_moments = RunningMoments(num_dims_out)
+    n = 0
+    written = {True: 0, False: 0}
+    for file_idx in xrange(num_files):
+        name, num_blocks, loader = tracks[file_idx]
+        print('Processing: {0}/{1}'.format((file_idx+1), num_files))
+        print('Filename: {0}'.format(name))
+        X = loader()
+        assert len(X) == num_blocks
+        num_windows = count_windows(len(X), max_seq_len, hop)
+        x_windows = strided_windows(X, max_seq_len, hop, num_windows)
+        # Windows never reach the last block, so the targets (X shifted by one block) are a view into X as well
+        y_windows = strided_windows(X[1:], max_seq_len, hop, num_windows)
+        with timer('convert.windows', items=num_windows):
+            for window_idx in xrange(num_windows):
+                is_val, idx = split_example_index(n, num_val, val_step)
+                if is_val:
+                    x_val[idx] = x_windows[window_idx]
+                    y_val[idx] = y_windows[window_idx]
+                    val_moments.update(x_windows[window_idx])
+                else:
+                    x_data[idx] = x_windows[window_idx]
+                    y_data[idx] = y_windows[window_idx]
+                    moments.update(x_windows[window_idx])
+                written[is_val] += 1
+                n += 1
+        print('Saved examples {0}/{1}'.format(n, num_examples))
+    assert n == num_examples
+    assert written[True] == num_val and written[False] == num_train
+    print('Normalizing...')
+    mean_x = moments.mean #Mean across num examples and num timesteps
+    std_x = moments.std() # STD across num examples and num timesteps
     std_x = np.maximum(1.0e-8, std_x) #Clamp variance if too tiny
-    x_data[:][:] -= mean_x #Mean 0
-    x_data[:][:] /= std_x #Variance 1
-    y_data[:][:] -= mean_x #Mean 0
-    y_data[:][:] /= std_x #Variance 1
-
-    np.save(out_file+'_mean', mean_x)
-    np.save(out_file+'_var', std_x)
-    np.save(out_file+'_x', x_data)
-    np.save(out_file+'_y', y_data)
+    normalize_tensor_in_place(x_data, mean_x, std_x)
+    normalize_tensor_in_place(y_data, mean_x, std_x)
+
+    print('Flushing to disk...')
+    with timer('convert.flush'):
+        save_dataset_info(out_file, {'feature_format': feature_format, 'useTimeDomain': useTimeDomain, 'block_size': int(block_size), 'max_seq_len': int(max_seq_len), 'hop': int(hop), 'dtype': dtype})
+        np.save(out_file+'_mean', mean_x)
+        np.save(out_file+'_var', std_x)
+        moments.save(out_file+'_stats.npz')
+        x_data.flush()
+        y_data.flush()
     
     # Center and save validation data, if present
     if num_val > 0:
-        val_mean_x = np.mean(np.mean(x_val, axis=0), axis=0) #Mean across num examples and num timesteps
-        val_std_x = np.sqrt(np.mean(np.mean(np.abs(x_val-val_mean_x)**2, axis=0), axis=0)) # STD across num examples and num timesteps
+        val_mean_x = val_moments.mean
+        val_std_x = val_moments.std()
         val_std_x = np.maximum(1.0e-8, val_std_x) #Clamp variance if too tiny
-        x_val[:][:] -= val_mean_x #Mean 0
-        x_val[:][:] /= val_std_x #Variance 1
-        y_val[:][:] -= val_mean_x #Mean 0
-        y_val[:][:] /= val_std_x #Variance 1
-        np.save(out_file+'_val_x', x_val)
-        np.save(out_file+'_val_y', y_val)
+        normalize_tensor_in_place(x_val, val_mean_x, val_std_x)
+        normalize_tensor_in_place(y_val, val_mean_x, val_std_x)
+        with timer('convert.flush'):
+            x_val.flush()
+            y_val.flush()
     print('Done!')
 
-def convert_nptensor_to_wav_files(tensor, indices, filename, useTimeDomain=False):
+def convert_nptensor_to_wav_files(tensor, indices, filename, useTimeDomain=False, feature_format='fft'):
     num_seqs = tensor.shape[1]
     for i in indices:
         chunks = []
         for x in xrange(num_seqs):
             chunks.append(tensor[i][x])
-        save_generated_example(filename+str(i)+'.wav', chunks,useTimeDomain=useTimeDomain)
+        save_generated_example(filename+str(i)+'.wav', chunks,useTimeDomain=useTimeDomain, feature_format=feature_format)
 
-def load_training_example(filename, block_size=2048, useTimeDomain=False):
+def load_training_example(filename, block_size=2048, useTimeDomain=False, feature_format='fft'):
+    X, Y = load_training_example_matrix(filename, block_size, useTimeDomain=useTimeDomain, feature_format=feature_format)
+    return list(X), list(Y)
+
+# Same as load_training_example, but returns (num_blocks, num_dims) matrices instead of lists of blocks
+def load_training_example_matrix(filename, block_size=2048, useTimeDomain=False, feature_format='fft'):
+    X = load_track_features(filename, block_size, useTimeDomain=useTimeDomain, feature_format=feature_format)
+    return X, shift_blocks(X)
+
+# Reads a WAV file as a (num_blocks, num_dims) float32 feature matrix
+def load_track_features(filename, block_size=2048, useTimeDomain=False, feature_format='fft'):
     data, sample_rate = read_wav_as_np(filename)
     assert sample_rate == 44100
     assert len(data.shape) == 1
     
-    x_t = convert_np_audio_to_sample_blocks(data, block_size)
-    y_t = x_t[1:]
-    y_t.append(np.zeros(block_size)) #Add special end block composed of all zeros
-    if useTimeDomain:
-        return x_t, y_t
-    X = time_blocks_to_fft_blocks(x_t)
-    Y = time_blocks_to_fft_blocks(y_t)
-    return X, Y
+    X = convert_np_audio_to_block_matrix(data, block_size)
+    if not useTimeDomain:
+        with timer('convert.fft', items=X.shape[0]):
+            # The FFT is computed in double precision (NumPy 2 would keep float32 input in single precision), then stored as float32
+            X = time_block_matrix_to_features(X.astype(np.float64), feature_format).astype('float32')
+    return X
+
+# The training targets for a block sequence: X shifted by one block, plus a special end block composed of all zeros
+# (which is also all zeros in frequency space)
+def shift_blocks(X):
+    return np.concatenate((X[1:], np.zeros((1, X.shape[1]), dtype=X.dtype)), axis=0)
+
+# Writes a mono 16-bit WAV file block by block, so a song never has to be held in memory as a whole.
+# The header is updated after every write, so the file is a valid WAV of everything written so far at all times.
+class WavStreamWriter:
+    def __init__(self, filename, sample_rate):
+        self.wav = wave.open(filename, 'wb')
+        self.wav.setnchannels(1)
+        self.wav.setsampwidth(2)
+        self.wav.setframerate(sample_rate)
+
+    # Appends time domain samples in [-1, 1], converted as in write_np_as_wav
+    def write(self, samples):
+        Xnew = np.asarray(samples) * 32767.0
+        self.wav.writeframes(Xnew.astype('<i2').tobytes())
+
+    def close(self):
+        self.wav.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Streaming version of save_generated_example: converts generated blocks to audio one at a time as they are
+# appended to an open WavStreamWriter (filename may also be a file object). If var and mean are given, each block is uncentered first.
+# Blocks are transformed independently, so the result is the same as converting the whole song at once (up to rounding).
+class GeneratedExampleWriter:
+    def __init__(self, filename, useTimeDomain=False, sample_frequency=44100, feature_format='fft', var=None, mean=None):
+        self.writer = WavStreamWriter(filename, sample_frequency)
+        self.useTimeDomain = useTimeDomain
+        self.feature_format = feature_format
+        self.var = var
+        self.mean = mean
+
+    def write_block(self, block):
+        block = np.array(block)
+        if self.var is not None:
+            # In place and in the block's own dtype, as sequence_generator.uncenter_output does
+            block *= self.var
+            block += self.mean
+        with timer('generate.write_block', items=1):
+            if not self.useTimeDomain:
+                block = features_to_time_block_matrix(block[np.newaxis, :], self.feature_format)[0]
+            self.writer.write(block)
+
+    def close(self):
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
-def save_generated_example(filename, generated_sequence, useTimeDomain=False, sample_frequency=44100):
+def save_generated_example(filename, generated_sequence, useTimeDomain=False, sample_frequency=44100, feature_format='fft'):
     if useTimeDomain:
         time_blocks = generated_sequence
     else:
-        time_blocks = fft_blocks_to_time_blocks(generated_sequence)
+        time_blocks = features_to_time_block_matrix(np.asarray(generated_sequence), feature_format)
     song = convert_sample_blocks_to_np_audio(time_blocks)
     write_np_as_wav(song, sample_frequency, filename)
     return
@@ -0,0 +1,51 @@
+import numpy as np
+
+# Streaming per-feature mean/variance accumulator.
+# Batches are folded in with the parallel form of Welford's algorithm (Chan et al.), so statistics can be
+# accumulated song by song without materializing the dataset, and accumulators built on different
+# processes or subsets of the data can be merged exactly.
+class RunningMoments:
+    def __init__(self, num_dims):
+        self.count = 0
+        self.mean = np.zeros((num_dims,), dtype='float64')
+        self.m2 = np.zeros((num_dims,), dtype='float64') # Sum of squared differences from the mean
+
+    # Adds a batch of values of shape (num_values, num_dims)
+    def update(self, values):
+        num_values = values.shape[0]
+        if num_values == 0:
+            return
+        batch_mean = np.mean(values, axis=0, dtype='float64')
+        batch_m2 = np.sum((values - batch_mean)**2, axis=0)
+        self.combine(num_values, batch_mean, batch_m2)
+
+    # Merges the statistics gathered by another accumulator into this one
+    def merge(self, other):
+        self.combine(other.count, other.mean, other.m2)
+
+    def combine(self, count, mean, m2):
+        if count == 0:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * (float(count) / total)
+        self.m2 += m2 + delta**2 * (float(self.count) * count / total)
+        self.count = total
+
+    def variance(self):
+        return self.m2 / max(self.count, 1)
+
+    def std(self):
+        return np.sqrt(self.variance())
+
+    def save(self, filename):
+        np.savez(filename, count=self.count, mean=self.mean, m2=self.m2)
+
+    @staticmethod
+    def load(filename):
+        data = np.load(filename)
+        moments = RunningMoments(data['mean'].shape[0])
+        moments.count = int(data['count'])
+        moments.mean = data['mean']
+        moments.m2 = data['m2']
+        return moments
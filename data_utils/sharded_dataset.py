@@ -0,0 +1,304 @@
+import os
+import json
+import numpy as np
+from data_utils.parse_files import *
+from data_utils.running_stats import RunningMoments
+from perf_utils.instrumentation import timer
+
+SHARDED_FORMAT_VERSION = 1
+
+# A sharded dataset consists of
+#  <out_file>_index.json        - small index: feature info, shapes, and for each split the shard files with their example ranges
+#  <out_file>_shards/*.npy      - the shards, in one of two layouts:
+#                                 'windows' - one x and one y shard per track and split, holding that track's
+#                                             (num_windows, num_timesteps, num_dims) normalized examples
+#                                 'blocks'  - one shard per track holding its raw (num_blocks + 1, num_dims) block sequence
+#                                             (including the zero end block) exactly once. x and y windows are strided views
+#                                             into it, offset by one block, and are normalized as they are read.
+#                                             This takes about a quarter of the space of the 'windows' layout with 50% overlap.
+#                                 The index also lists every track of a 'blocks' dataset, including those too short for a
+#                                 single window, so that variable-length sequences can be taken from them (see load_sequence_dataset).
+#  <out_file>_mean.npy/_var.npy - normalization statistics, as for the monolithic format (plus _val_mean.npy/_val_var.npy
+#                                 for the separately normalized validation split)
+# Shards are memory-mapped on first use, so opening a dataset costs the same regardless of its size, and several
+# processes using the same dataset share one copy of it in the page cache.
+
+def index_filename(out_file):
+    return out_file + '_index.json'
+
+def is_sharded_dataset(out_file):
+    return os.path.isfile(index_filename(out_file))
+
+# Writes training data for a list of (name, num_blocks, loader) tracks (see parse_files.convert_tracks_to_nptensor)
+# as a sharded dataset. Examples and the train/validation split are the same as for the monolithic format.
+# If store_blocks is set, the 'blocks' layout is used instead of the 'windows' one.
+# A window is taken every hop blocks (default_hop if None). Shards are stored as dtype (see parse_files.STORAGE_DTYPES).
+def convert_tracks_to_sharded_dataset(tracks, block_size, max_seq_len, out_file, validation_split=0.0, useTimeDomain=False, feature_format='fft', store_blocks=False, hop=None, dtype='float32'):
+    check_storage_dtype(dtype, block_size, useTimeDomain)
+    shard_directory = out_file + '_shards'
+    if not os.path.isdir(shard_directory):
+        os.makedirs(shard_directory)
+    for file in os.listdir(shard_directory):
+        if file.endswith('.npy'):
+            os.remove(os.path.join(shard_directory, file)) # Shards left over from a previous conversion
+    num_files = len(tracks)
+    if hop is None:
+        hop = default_hop(max_seq_len)
+    num_examples = 0
+    for name, num_blocks, loader in tracks:
+        num_examples += count_windows(num_blocks, max_seq_len, hop)
+    num_val, val_step = validation_split_params(num_examples, validation_split)
+    num_dims_out = feature_dimensions(block_size, feature_format)
+    if(useTimeDomain):
+        num_dims_out = int(block_size)
+    splits = {'train': {'num_examples': 0, 'shards': []}, 'val': {'num_examples': 0, 'shards': []}}
+    track_index = []
+    moments = {'train': RunningMoments(num_dims_out), 'val': RunningMoments(num_dims_out)}
+    n = 0
+    for file_idx in xrange(num_files):
+        name, num_blocks, loader = tracks[file_idx]
+        print('Processing: {0}/{1}'.format((file_idx+1), num_files))
+        print('Filename: {0}'.format(name))
+        X = loader()
+        assert len(X) == num_blocks
+        windows = {'train': [], 'val': []}
+        num_windows = count_windows(len(X), max_seq_len, hop)
+        for window_idx in xrange(num_windows):
+            is_val, idx = split_example_index(n, num_val, val_step)
+            windows['val' if is_val else 'train'].append(window_idx)
+            n += 1
+        if store_blocks:
+            blocks = np.concatenate((X, np.zeros((1, X.shape[1]), dtype=X.dtype)), axis=0).astype(dtype) # Blocks plus the zero end block
+            blocks_name = 'track_{0:05d}.npy'.format(file_idx)
+            with timer('convert.write', items=blocks.shape[0]):
+                np.save(os.path.join(shard_directory, blocks_name), blocks)
+            track_index.append({'track': name, 'blocks': blocks_name, 'num_blocks': int(num_blocks)})
+            x_windows = strided_windows(blocks, max_seq_len, hop, num_windows)
+        else:
+            x_windows = strided_windows(X, max_seq_len, hop, num_windows)
+            y_windows = strided_windows(X[1:], max_seq_len, hop, num_windows) # Windows never reach the last block
+        for split in ('train', 'val'):
+            if len(windows[split]) == 0:
+                continue
+            with timer('convert.windows', items=len(windows[split])):
+                for window_idx in windows[split]:
+                    moments[split].update(x_windows[window_idx])
+            shard = {'track': name, 'start': splits[split]['num_examples'], 'count': len(windows[split])}
+            if store_blocks:
+                shard['blocks'] = blocks_name
+                shard['windows'] = windows[split]
+            else:
+                shard_name = '{0}_{1:05d}'.format(split, file_idx)
+                with timer('convert.write', items=2*len(windows[split])*max_seq_len): # Items are blocks written, as for the 'blocks' layout
+                    np.save(os.path.join(shard_directory, shard_name + '_x.npy'), x_windows[windows[split]].astype(dtype))
+                    np.save(os.path.join(shard_directory, shard_name + '_y.npy'), y_windows[windows[split]].astype(dtype))
+                shard['x'] = shard_name + '_x.npy'
+                shard['y'] = shard_name + '_y.npy'
+            splits[split]['shards'].append(shard)
+            splits[split]['num_examples'] += len(windows[split])
+        print('Saved examples {0}/{1}'.format(n, num_examples))
+    assert n == num_examples
+    assert splits['val']['num_examples'] == num_val and splits['train']['num_examples'] == num_examples - num_val
+
+    print('Normalizing...')
+    for split in ('train', 'val'):
+        mean_x = moments[split].mean #Mean across num examples and num timesteps
+        std_x = np.maximum(1.0e-8, moments[split].std()) #Clamp variance if too tiny
+        if not store_blocks:
+            # Block shards are shared by both splits and stay raw; they are normalized as they are read instead
+            for shard in splits[split]['shards']:
+                for key in ('x', 'y'):
+                    data = np.load(os.path.join(shard_directory, shard[key]), mmap_mode='r+')
+                    normalize_tensor_in_place(data, mean_x, std_x)
+                    data.flush()
+        prefix = out_file + ('_val' if split == 'val' else '')
+        np.save(prefix+'_mean', mean_x)
+        np.save(prefix+'_var', std_x)
+        moments[split].save(prefix+'_stats.npz')
+        splits[split]['mean'] = os.path.basename(prefix+'_mean.npy')
+        splits[split]['std'] = os.path.basename(prefix+'_var.npy')
+
+    info = {'feature_format': feature_format, 'useTimeDomain': useTimeDomain, 'block_size': int(block_size), 'max_seq_len': int(max_seq_len), 'hop': int(hop), 'dtype': dtype}
+    save_dataset_info(out_file, info)
+    index = {'version': SHARDED_FORMAT_VERSION, 'info': info, 'shard_directory': os.path.basename(shard_directory),
+             'layout': 'blocks' if store_blocks else 'windows', 'hop': int(hop),
+             'num_timesteps': int(max_seq_len), 'num_dims': int(num_dims_out), 'splits': splits,
+             'validation_split': float(validation_split)}
+    if store_blocks:
+        index['tracks'] = track_index
+    with open(index_filename(out_file), 'w') as f:
+        json.dump(index, f)
+    print('Done!')
+
+# Read-only, array-like view of one tensor (x or y) of a sharded dataset split. Examples are always returned as float32,
+# whatever the storage dtype.
+# Supports the indexing used by training and generation (integers, slices and integer arrays along the first axis),
+# loading only the shards that are actually touched. rows(shard_idx, local_indices) returns the examples with the given
+# indices within a shard, as float32; it is what differs between shard layouts.
+class ShardedArray:
+    def __init__(self, shard_directory, shards, num_timesteps, num_dims, rows):
+        self.shard_directory = shard_directory
+        self.rows = rows
+        self.starts = np.array([shard['start'] for shard in shards] + [sum(shard['count'] for shard in shards)], dtype='int64')
+        self.shards = [None] * len(shards)
+        self.shape = (int(self.starts[-1]), num_timesteps, num_dims)
+        self.ndim = 3
+        self.dtype = np.dtype('float32')
+
+    def __len__(self):
+        return self.shape[0]
+
+    def load_shard(self, filename):
+        return np.load(os.path.join(self.shard_directory, filename), mmap_mode='r')
+
+    def __getitem__(self, item):
+        if isinstance(item, tuple):
+            rows = self[item[0]]
+            if np.isscalar(item[0]):
+                return rows[item[1:]]
+            return rows[(slice(None),) + item[1:]]
+        if isinstance(item, slice):
+            return self[np.arange(*item.indices(len(self)))]
+        if np.isscalar(item):
+            idx = int(item)
+            if idx < 0:
+                idx += len(self)
+            if idx < 0 or idx >= len(self):
+                raise IndexError('index {0} is out of bounds for axis 0 with size {1}'.format(item, len(self)))
+            shard_idx = np.searchsorted(self.starts, idx, side='right') - 1
+            return self.rows(shard_idx, np.array([idx - self.starts[shard_idx]]))[0]
+        indices = np.asarray(item, dtype='int64').ravel()
+        indices = np.where(indices < 0, indices + len(self), indices)
+        if np.any(indices < 0) or np.any(indices >= len(self)):
+            raise IndexError('index out of bounds for axis 0 with size {0}'.format(len(self)))
+        result = np.empty((indices.shape[0],) + self.shape[1:], dtype=self.dtype)
+        shard_ids = np.searchsorted(self.starts, indices, side='right') - 1
+        for shard_idx in np.unique(shard_ids):
+            mask = shard_ids == shard_idx
+            result[mask] = self.rows(shard_idx, indices[mask] - self.starts[shard_idx])
+        return result.reshape(np.shape(item) + self.shape[1:])
+
+    def __array__(self, dtype=None):
+        result = self[0:len(self)]
+        return result if dtype is None else result.astype(dtype)
+
+# Examples stored as normalized windows ('windows' layout). key is 'x' or 'y'.
+class WindowShardArray(ShardedArray):
+    def __init__(self, shard_directory, shards, key, num_timesteps, num_dims):
+        ShardedArray.__init__(self, shard_directory, shards, num_timesteps, num_dims, self.window_rows)
+        self.filenames = [shard[key] for shard in shards]
+
+    def window_rows(self, shard_idx, local_indices):
+        if self.shards[shard_idx] is None:
+            self.shards[shard_idx] = self.load_shard(self.filenames[shard_idx])
+        return np.asarray(self.shards[shard_idx][local_indices], dtype=self.dtype)
+
+# Examples taken as strided windows from raw per-track block sequences ('blocks' layout) and normalized on the fly.
+# offset is 0 for x and 1 for y, which is just x shifted by one block.
+class BlockWindowArray(ShardedArray):
+    def __init__(self, shard_directory, shards, offset, hop, num_timesteps, num_dims, mean, std):
+        ShardedArray.__init__(self, shard_directory, shards, num_timesteps, num_dims, self.block_window_rows)
+        self.filenames = [shard['blocks'] for shard in shards]
+        self.windows = [np.array(shard['windows'], dtype='int64') for shard in shards]
+        self.offset = offset
+        self.hop = hop
+        self.mean = mean.astype('float32')
+        self.std = std.astype('float32')
+
+    def block_window_rows(self, shard_idx, local_indices):
+        if self.shards[shard_idx] is None:
+            blocks = self.load_shard(self.filenames[shard_idx])
+            num_windows = count_windows(blocks.shape[0] - self.offset, self.shape[1], self.hop)
+            self.shards[shard_idx] = strided_windows(blocks[self.offset:], self.shape[1], self.hop, num_windows)
+        result = np.array(self.shards[shard_idx][self.windows[shard_idx][local_indices]], dtype=self.dtype)
+        result -= self.mean #Mean 0
+        result /= self.std #Variance 1
+        return result
+
+# Returns the index of a sharded dataset along with the directories of the dataset and of its shards
+def read_index(out_file):
+    with open(index_filename(out_file)) as f:
+        index = json.load(f)
+    assert index['version'] == SHARDED_FORMAT_VERSION
+    directory = os.path.dirname(index_filename(out_file))
+    return index, directory, os.path.join(directory, index['shard_directory'])
+
+# Opens one split ('train' or 'val') of a sharded dataset, returning lazily loaded (x, y) arrays
+def load_sharded_dataset(out_file, split='train'):
+    index, directory, shard_directory = read_index(out_file)
+    split_index = index['splits'][split]
+    shards = split_index['shards']
+    if index.get('layout', 'windows') == 'blocks':
+        mean = np.load(os.path.join(directory, split_index['mean']))
+        std = np.load(os.path.join(directory, split_index['std']))
+        x = BlockWindowArray(shard_directory, shards, 0, index['hop'], index['num_timesteps'], index['num_dims'], mean, std)
+        y = BlockWindowArray(shard_directory, shards, 1, index['hop'], index['num_timesteps'], index['num_dims'], mean, std)
+    else:
+        x = WindowShardArray(shard_directory, shards, 'x', index['num_timesteps'], index['num_dims'])
+        y = WindowShardArray(shard_directory, shards, 'y', index['num_timesteps'], index['num_dims'])
+    return x, y
+
+# Variable-length training sequences taken from the raw block shards of a 'blocks' layout dataset.
+# segments is a list of (blocks filename, start block, num_blocks). Item i is the (x, y) pair for segment i,
+# each of shape (num_blocks, num_dims), where y is x shifted by one block; both are normalized as they are read.
+class SequenceDataset:
+    def __init__(self, shard_directory, segments, num_dims, mean, std):
+        self.shard_directory = shard_directory
+        self.segments = segments
+        self.lengths = np.array([length for filename, start, length in segments], dtype='int64')
+        self.num_dims = num_dims
+        self.mean = mean.astype('float32')
+        self.std = std.astype('float32')
+        self.shards = {}
+
+    def __len__(self):
+        return len(self.segments)
+
+    def __getitem__(self, idx):
+        filename, start, length = self.segments[idx]
+        if filename not in self.shards:
+            self.shards[filename] = np.load(os.path.join(self.shard_directory, filename), mmap_mode='r')
+        # Every track is stored with its zero end block, so the y of a segment reaching the end of the song is still available
+        seq = np.array(self.shards[filename][start:start+length+1], dtype='float32')
+        seq -= self.mean #Mean 0
+        seq /= self.std #Variance 1
+        return seq[:-1], seq[1:]
+
+# Opens one split of a 'blocks' layout dataset as variable-length sequences instead of fixed-length windows.
+# Each song is cut into segments of at most max_len blocks (whole songs if max_len is None), including the tails
+# and short songs that don't fill a window. Segments are split between training and validation in the same
+# interleaved way as windows, and both splits are normalized with the training statistics.
+def load_sequence_dataset(out_file, split='train', max_len=None):
+    index, directory, shard_directory = read_index(out_file)
+    if index.get('layout', 'windows') != 'blocks' or 'tracks' not in index:
+        raise ValueError('{0} does not store whole songs; convert it with --sharded --blocks to train on variable-length sequences'.format(out_file))
+    segments = []
+    for track in index['tracks']:
+        num_blocks = track['num_blocks']
+        segment_len = max_len if max_len else num_blocks
+        for start in xrange(0, num_blocks, max(segment_len, 1)):
+            segments.append((track['blocks'], start, min(segment_len, num_blocks - start)))
+    num_val, val_step = validation_split_params(len(segments), index['validation_split'])
+    chosen = []
+    for n in xrange(len(segments)):
+        is_val, idx = split_example_index(n, num_val, val_step)
+        if is_val == (split == 'val'):
+            chosen.append(segments[n])
+    mean = np.load(os.path.join(directory, index['splits']['train']['mean']))
+    std = np.load(os.path.join(directory, index['splits']['train']['std']))
+    return SequenceDataset(shard_directory, chosen, index['num_dims'], mean, std)
+
+# Opens a dataset split in either the sharded or the monolithic format.
+# Monolithic .npy files are memory-mapped, so in both cases examples are only read from disk when they are used.
+# Reduced precision monolithic files are wrapped as a single shard, so that examples are upcast to float32 as they are read.
+def load_dataset(out_file, split='train'):
+    if is_sharded_dataset(out_file):
+        return load_sharded_dataset(out_file, split)
+    prefix = out_file + ('_val' if split == 'val' else '')
+    x = np.load(prefix + '_x.npy', mmap_mode='r')
+    y = np.load(prefix + '_y.npy', mmap_mode='r')
+    if x.dtype == np.float32:
+        return x, y
+    directory = os.path.dirname(prefix) or '.'
+    shards = [{'start': 0, 'count': x.shape[0], 'x': os.path.basename(prefix + '_x.npy'), 'y': os.path.basename(prefix + '_y.npy')}]
+    return WindowShardArray(directory, shards, 'x', x.shape[1], x.shape[2]), WindowShardArray(directory, shards, 'y', y.shape[1], y.shape[2])
@@ -0,0 +1,19 @@
+from __future__ import print_function
+from nn_utils.numpy_engine import export_weights, RECURRENT_ACTIVATIONS
+import config.nn_config as nn_config
+import argparse
+
+# Exports trained generator weights for generate.py --numpy, e.g. to copy them to machines without Keras/TensorFlow
+config = nn_config.get_neural_net_configuration()
+parser = argparse.ArgumentParser(description="Export generator weights to a .npz file for the NumPy inference engine.")
+parser.add_argument("--iteration", default=0, type=int, help="Training iteration to export the weights of.")
+parser.add_argument("-r", "--run", default=0, type=int, help="Integer id for the run (used for weight files). Defaults to zero.")
+parser.add_argument("--weights", default=None, type=str, help="Weights file to export. Overrides --iteration and --run.")
+parser.add_argument("--recurrent-activation", default=None, choices=sorted(RECURRENT_ACTIVATIONS), help="LSTM recurrent activation the model was trained with. Defaults to Keras' default for the version that saved the weights.")
+args = parser.parse_args()
+
+model_filename = args.weights
+if model_filename is None:
+    model_filename = config['model_basename'] + str(args.run) + '_' + str(args.iteration)
+print('Exporting weights from {0} to {1}'.format(model_filename, model_filename + '.npz'))
+export_weights(model_filename, model_filename + '.npz', args.recurrent_activation)
@@ -0,0 +1,179 @@
+import io
+import time
+import threading
+from collections import OrderedDict
+import gen_utils.seed_generator as seed_generator
+import gen_utils.sequence_generator as sequence_generator
+from data_utils.parse_files import GeneratedExampleWriter
+
+# Resident generation backend for generation_server.py: keeps the seed dataset, normalization statistics and recently
+# used models in memory, and runs concurrent requests for the same model together as one batch.
+
+# Least recently used cache of loaded models. load(key) is called on a miss and returns the value to cache,
+# e.g. a stepper for the weights of a (run, iteration) pair.
+class ModelCache:
+    def __init__(self, load, capacity=2):
+        self.load = load
+        self.capacity = max(capacity, 1)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock() # Guards entries against keys() from other threads; loads happen outside it
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None) # Re-inserted below as the most recently used
+        if value is None:
+            self.misses += 1
+            value = self.load(key)
+        else:
+            self.hits += 1
+        with self.lock:
+            while len(self.entries) >= self.capacity:
+                self.entries.popitem(last=False)
+            self.entries[key] = value
+        return value
+
+    def keys(self):
+        with self.lock:
+            return list(self.entries.keys())
+
+# One song to generate. Requests with the same batch_key() can share generation steps.
+class GenerationRequest:
+    def __init__(self, model_key, seq_len, seed_len=1, include_raw_seed=False, include_model_seed=False):
+        self.model_key = model_key
+        self.seq_len = seq_len
+        self.seed_len = seed_len
+        self.include_raw_seed = include_raw_seed
+        self.include_model_seed = include_model_seed
+        self.submitted = time.time()
+        self.done = threading.Event()
+        self.wav = None # The generated song as WAV file contents
+        self.error = None
+
+    # Requests can only be batched if they use the same model and are primed the same way. Their lengths may differ:
+    # the batch runs for the longest one, and each song only keeps its own first seq_len blocks. Songs in a batch don't
+    # interact, so that's what the song would have got on its own (up to float rounding).
+    def batch_key(self):
+        return (self.model_key, self.seed_len, self.include_raw_seed, self.include_model_seed)
+
+    # Blocks until the request has been served. Returns the WAV file contents, or raises the error generation hit.
+    def wait(self, timeout=None):
+        if not self.done.wait(timeout):
+            raise RuntimeError('Generation timed out')
+        if self.error is not None:
+            raise self.error
+        return self.wav
+
+# Serves GenerationRequests on a single worker thread, which also loads the models, so Keras/TensorFlow are only
+# ever used from one thread. Requests that arrive within batch_window seconds of each other, or while a batch is
+# being generated, are coalesced into one batch of up to max_batch songs per model.
+class GenerationService:
+    def __init__(self, models, training_data, X_var, X_mean, dataset_info, sample_frequency=44100, max_batch=16, batch_window=0.01):
+        self.models = models
+        self.training_data = training_data
+        self.X_var = X_var
+        self.X_mean = X_mean
+        self.dataset_info = dataset_info
+        self.sample_frequency = sample_frequency
+        self.max_batch = max(max_batch, 1)
+        self.batch_window = batch_window
+        self.pending = []
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+        self.num_requests = 0
+        self.num_batches = 0
+        self.generation_seconds = 0.0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def submit(self, request):
+        with self.condition:
+            self.pending.append(request)
+            self.condition.notify_all()
+        return request
+
+    # Convenience wrapper: submit and wait
+    def generate(self, request, timeout=None):
+        return self.submit(request).wait(timeout)
+
+    # Takes the oldest pending request and up to max_batch - 1 more that can be batched with it
+    def next_batch(self):
+        with self.condition:
+            while self.running and len(self.pending) == 0:
+                self.condition.wait()
+            if not self.running:
+                return []
+            # Give concurrent clients a moment to join the batch
+            deadline = self.pending[0].submitted + self.batch_window
+            while self.running and len(self.pending) < self.max_batch and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+            key = self.pending[0].batch_key()
+            batch = [request for request in self.pending if request.batch_key() == key][:self.max_batch]
+            self.pending = [request for request in self.pending if request not in batch]
+            return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if len(batch) == 0:
+                break
+            try:
+                self.generate_batch(batch)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            finally:
+                for request in batch:
+                    request.done.set()
+        # Fail whatever is left, so no client waits forever
+        with self.condition:
+            for request in self.pending:
+                request.error = RuntimeError('Generation service stopped')
+                request.done.set()
+            self.pending = []
+
+    def generate_batch(self, batch):
+        first = batch[0]
+        stepper = self.models.get(first.model_key)
+        start = time.time()
+        seeds = seed_generator.generate_copy_seed_sequences(seed_length=first.seed_len, training_data=self.training_data, count=len(batch))
+        seq_lens = [request.seq_len for request in batch]
+        buffers = [io.BytesIO() for request in batch]
+        writers = [GeneratedExampleWriter(buffer, self.dataset_info['useTimeDomain'], self.sample_frequency, self.dataset_info['feature_format'], self.X_var, self.X_mean) for buffer in buffers]
+        try:
+            steps = sequence_generator.iterate_batch_from_seed_incremental(stepper, seeds, max(seq_lens), first.include_raw_seed, first.include_model_seed)
+            for i, step in enumerate(steps):
+                for n in range(len(batch)):
+                    if i < seq_lens[n]:
+                        writers[n].write_block(step[n])
+        finally:
+            for writer in writers:
+                writer.close()
+        for request, buffer in zip(batch, buffers):
+            request.wav = buffer.getvalue()
+        self.num_requests += len(batch)
+        self.num_batches += 1
+        self.generation_seconds += time.time() - start
+
+    def status(self):
+        with self.condition:
+            num_pending = len(self.pending)
+        return {'pending': num_pending, 'requests': self.num_requests, 'batches': self.num_batches,
+                'mean_batch_size': self.num_requests / float(max(self.num_batches, 1)),
+                'generation_seconds': self.generation_seconds,
+                'cached_models': [list(key) for key in self.models.keys()],
+                'cache_hits': self.models.hits, 'cache_misses': self.models.misses}
@@ -0,0 +1,53 @@
+import numpy as np
+
+EVICTION_POLICIES = ('fifo', 'random')
+
+# Bounded pool of previously generated fake examples for training the GAN decoder.
+# Generating fakes means running the generator autoregressively, which dominates a GAN iteration; with a replay
+# buffer only a refresh_fraction of each decoder batch has to be freshly generated, and the rest is drawn from
+# earlier iterations' fakes. Once the buffer holds capacity examples, new ones replace the oldest ('fifo') or
+# randomly chosen ('random') entries.
+class ReplayBuffer:
+    def __init__(self, capacity, refresh_fraction=0.5, eviction='fifo', seed=None):
+        assert eviction in EVICTION_POLICIES
+        self.capacity = max(int(capacity), 0)
+        self.refresh_fraction = min(max(refresh_fraction, 0.0), 1.0)
+        self.eviction = eviction
+        self.random = np.random.RandomState(seed)
+        self.examples = None # Allocated on the first add, once the example shape is known
+        self.size = 0
+        self.next = 0 # Oldest entry, overwritten next under 'fifo' eviction
+
+    def __len__(self):
+        return self.size
+
+    # Number of the count fakes needed for a decoder batch that have to be freshly generated
+    def num_fresh(self, count):
+        if self.capacity == 0:
+            return count
+        return min(max(int(np.ceil(self.refresh_fraction * count)), count - self.size), count)
+
+    # Draws count distinct stored examples (count must be at most len(self))
+    def sample(self, count):
+        indices = self.random.choice(self.size, size=count, replace=False)
+        return self.examples[np.sort(indices)]
+
+    # Stores newly generated examples of shape (num_examples, num_timesteps, num_dims), evicting old ones if full
+    def add(self, examples):
+        if self.capacity == 0 or len(examples) == 0:
+            return
+        if self.examples is None:
+            self.examples = np.zeros((self.capacity,) + examples.shape[1:], dtype=examples.dtype)
+        examples = examples[-self.capacity:]
+        num_free = min(self.capacity - self.size, len(examples))
+        self.examples[self.size:self.size+num_free] = examples[:num_free]
+        self.size += num_free
+        examples = examples[num_free:]
+        if len(examples) == 0:
+            return
+        if self.eviction == 'fifo':
+            slots = (self.next + np.arange(len(examples))) % self.capacity
+            self.next = (self.next + len(examples)) % self.capacity
+        else:
+            slots = self.random.choice(self.capacity, size=len(examples), replace=False)
+        self.examples[slots] = examples
@@ -3,10 +3,39 @@ import numpy as np
 #A very simple seed generator
 #Copies a random example's first seed_length sequences as input to the generation algorithm
 def generate_copy_seed_sequence(seed_length, training_data):
+    return generate_copy_seed_sequences(seed_length, training_data, count=1)
+
+#Batched version of generate_copy_seed_sequence, returning count seeds of shape (count, seed_length*num_timesteps, num_dims)
+#All examples are gathered with a single index selection instead of one read and concatenation per seed
+def generate_copy_seed_sequences(seed_length, training_data, count):
     num_examples = training_data.shape[0]
+    randIdx = np.random.randint(num_examples - seed_length, size=count)
+    return copy_seed_sequences(seed_length, training_data, randIdx)
+
+#Seeds made of the seed_length consecutive examples starting at each of the given example indices
+def copy_seed_sequences(seed_length, training_data, start_indices):
+    count = len(start_indices)
     example_len = training_data.shape[1]
-    randIdx = np.random.randint(num_examples - seed_length, size=1)[0]
-    randSeed = np.concatenate(tuple([training_data[randIdx + i] for i in xrange(seed_length)]), axis=0)
-    seedSeq = np.reshape(randSeed, (1, randSeed.shape[0], randSeed.shape[1]))
-    return seedSeq
+    seedIdx = (np.asarray(start_indices)[:,np.newaxis] + np.arange(seed_length)[np.newaxis,:]).ravel()
+    seedSeq = np.asarray(training_data[seedIdx])
+    return np.reshape(seedSeq, (count, seed_length*example_len, seedSeq.shape[-1]))
 
+#Picks the seeds' first examples with a seed_index.SeedIndex instead of uniformly at random:
+# 'similar'    - the count examples most similar to the reference embedding
+# 'dissimilar' - the count examples least similar to it
+# 'diverse'    - count examples spread out over the whole library
+#Without a reference embedding, a random example's embedding is used.
+def generate_indexed_seed_sequences(seed_length, training_data, count, index, mode='similar', reference=None):
+    num_candidates = training_data.shape[0] - seed_length
+    if mode == 'random':
+        return generate_copy_seed_sequences(seed_length, training_data, count)
+    if mode == 'diverse':
+        start_indices = index.diverse(count, num_candidates)
+    else:
+        if reference is None:
+            reference = index.embeddings[np.random.randint(num_candidates)]
+        start_indices = index.query(reference[np.newaxis, :], count, num_candidates, farthest=(mode == 'dissimilar'))[0][0]
+    if len(start_indices) < count:
+        #Fewer candidates than seeds, so some are repeated
+        start_indices = np.resize(start_indices, count)
+    return copy_seed_sequences(seed_length, training_data, start_indices)
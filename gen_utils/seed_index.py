@@ -0,0 +1,120 @@
+import os
+import numpy as np
+
+SEED_INDEX_VERSION = 1
+
+SEED_MODES = ('random', 'similar', 'dissimilar', 'diverse')
+
+# Precomputed index of compact per-example embeddings, for picking generation seeds by similarity (to a reference
+# clip) or diversity without reading the training tensor. It is stored in <out_file>_seed_index.npz next to the
+# dataset and rebuilt by load_or_build_seed_index whenever the dataset is newer than it.
+#
+# An example's embedding is its pooled spectrum: the time average and RMS of each (normalized) feature dimension,
+# averaged over num_bands bands of adjacent dimensions, minus the library's average pooled spectrum and scaled to unit
+# length. Similarity is the dot product of two embeddings (cosine similarity), so a batch of queries against the whole
+# index is one matrix product.
+
+def seed_index_filename(out_file):
+    return out_file + '_seed_index.npz'
+
+# Modification time of a dataset's files, in either the sharded or the monolithic format
+def dataset_mtime(out_file):
+    filenames = [out_file + '_index.json', out_file + '_x.npy']
+    return max([os.path.getmtime(filename) for filename in filenames if os.path.isfile(filename)] + [0.0])
+
+# Pooled spectra of a (num_sequences, num_timesteps, num_dims) batch of normalized examples: (num_sequences, 2 * num_bands)
+def pooled_spectra(examples, num_bands):
+    examples = np.asarray(examples, dtype='float32')
+    num_dims = examples.shape[2]
+    num_bands = min(num_bands, num_dims)
+    bands = np.arange(num_dims) * num_bands // num_dims
+    band_sizes = np.bincount(bands, minlength=num_bands).astype('float32')
+    # Summing dims into bands is a product with a (num_dims, num_bands) 0/1 matrix
+    pooling = np.zeros((num_dims, num_bands), dtype='float32')
+    pooling[np.arange(num_dims), bands] = 1.0
+    mean = np.dot(examples.mean(axis=1), pooling) / band_sizes
+    rms = np.sqrt(np.dot(np.square(examples).mean(axis=1), pooling) / band_sizes)
+    return np.concatenate((mean, rms), axis=1)
+
+# Embeddings of pooled spectra, given the library's average pooled spectrum
+def normalize_embeddings(spectra, center):
+    embeddings = spectra - center
+    embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1.0e-8)
+    return embeddings.astype('float32')
+
+class SeedIndex:
+    def __init__(self, embeddings, center, num_bands):
+        self.embeddings = np.asarray(embeddings, dtype='float32')
+        self.center = np.asarray(center, dtype='float32')
+        self.num_bands = int(num_bands)
+
+    def __len__(self):
+        return self.embeddings.shape[0]
+
+    def save(self, filename):
+        tmp_filename = filename + '.tmp.npz'
+        np.savez(tmp_filename, version=SEED_INDEX_VERSION, embeddings=self.embeddings, center=self.center, num_bands=self.num_bands)
+        os.rename(tmp_filename, filename)
+
+    # Embeds (num_sequences, num_timesteps, num_dims) normalized examples the same way as the indexed ones
+    def embed(self, examples):
+        return normalize_embeddings(pooled_spectra(examples, self.num_bands), self.center)
+
+    # Batched k-nearest neighbours: returns (indices, similarities), both (num_queries, k), most similar first.
+    # Only the first num_candidates examples are considered (all if None); if farthest is set, the least similar
+    # ones are returned instead.
+    def query(self, queries, k, num_candidates=None, farthest=False):
+        queries = np.asarray(queries, dtype='float32')
+        candidates = self.embeddings[:num_candidates]
+        k = min(k, candidates.shape[0])
+        similarities = np.dot(queries, candidates.T)
+        if farthest:
+            similarities = -similarities
+        # Partial sort for the top k, then sort only those
+        top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        top_similarities = np.take_along_axis(similarities, top, axis=1)
+        order = np.argsort(-top_similarities, axis=1)
+        indices = np.take_along_axis(top, order, axis=1)
+        top_similarities = np.take_along_axis(top_similarities, order, axis=1)
+        return indices, (-top_similarities if farthest else top_similarities)
+
+    # Picks count examples that are spread out over the library by farthest point sampling: starting from a random
+    # example, each pick is the example least similar to its most similar already picked one
+    def diverse(self, count, num_candidates=None, random=np.random):
+        candidates = self.embeddings[:num_candidates]
+        count = min(count, candidates.shape[0])
+        picked = [random.randint(candidates.shape[0])]
+        max_similarity = np.dot(candidates, candidates[picked[0]])
+        max_similarity[picked[0]] = np.inf
+        while len(picked) < count:
+            idx = int(np.argmin(max_similarity))
+            picked.append(idx)
+            max_similarity = np.maximum(max_similarity, np.dot(candidates, candidates[idx]))
+            max_similarity[idx] = np.inf
+        return np.array(picked)
+
+# Embeds all examples of a training tensor, chunk_size at a time, so memory-mapped datasets are read sequentially once
+def build_seed_index(training_data, num_bands=64, chunk_size=256):
+    spectra = []
+    for start in range(0, training_data.shape[0], chunk_size):
+        spectra.append(pooled_spectra(training_data[start:start+chunk_size], num_bands))
+    spectra = np.concatenate(spectra, axis=0)
+    center = spectra.mean(axis=0)
+    return SeedIndex(normalize_embeddings(spectra, center), center, num_bands)
+
+def load_seed_index(filename):
+    data = np.load(filename)
+    assert int(data['version']) == SEED_INDEX_VERSION
+    return SeedIndex(data['embeddings'], data['center'], int(data['num_bands']))
+
+# Loads the seed index of a dataset, building and saving it first if it is missing, out of date or built with other parameters
+def load_or_build_seed_index(out_file, training_data, num_bands=64):
+    filename = seed_index_filename(out_file)
+    if os.path.isfile(filename) and os.path.getmtime(filename) >= dataset_mtime(out_file):
+        index = load_seed_index(filename)
+        if len(index) == training_data.shape[0] and index.num_bands == num_bands:
+            return index
+    print('Building seed index {0}'.format(filename))
+    index = build_seed_index(training_data, num_bands)
+    index.save(filename)
+    return index
@@ -1,19 +1,33 @@
 import numpy as np
+from perf_utils.instrumentation import timer
 
 # Extrapolates from a given seed sequence.
 def generate_from_seed(model, seed, max_seq_len, include_raw_seed=False, include_model_seed=False, uncenter_data=False, data_variance=[], data_mean=[]):
     assert seed.shape[0] == 1
-    #print "seed.shape[1] = %d" % seed.shape[1]
-    #print "seed.shape[2] = %d" % seed.shape[2]
-    seedSeq = seed.copy()
+    return generate_batch_from_seed(model, seed, max_seq_len, include_raw_seed, include_model_seed, uncenter_data, data_variance, data_mean)[0]
+
+# Extrapolates from a given seed sequence one block at a time.
+# Instead of re-running the model over the whole sequence for every new block (O(n^2) in the song length),
+# the stepper carries the network state between steps, so each new block costs O(1).
+# 'stepper' is anything with reset(batch_size) and step(x), e.g. network_utils.LSTMStepper.
+# The output matches generate_from_seed to within float32 rounding (about 1e-5 absolute).
+def generate_from_seed_incremental(stepper, seed, max_seq_len, include_raw_seed=False, include_model_seed=False, uncenter_data=False, data_variance=[], data_mean=[]):
+    assert seed.shape[0] == 1
+    return generate_batch_from_seed_incremental(stepper, seed, max_seq_len, include_raw_seed, include_model_seed, uncenter_data, data_variance, data_mean)[0]
+
+# Extrapolates from a batch of seed sequences of shape (num_songs, seed_timesteps, num_frequency_dims).
+# All songs advance together, so each step is a single batched model call.
+# Returns one list of generated blocks per song, exactly as generate_from_seed would for that seed.
+def generate_batch_from_seed(model, seeds, max_seq_len, include_raw_seed=False, include_model_seed=False, uncenter_data=False, data_variance=[], data_mean=[]):
+    seedSeq = seeds.copy()
     output = []
     seq_len = 0
     if include_raw_seed:
         for i in xrange(seedSeq.shape[1]):
-            output.append(seedSeq[0][i])
+            output.append(seedSeq[:, i])
             seq_len += 1
         for i in xrange(10):
-            output.append(np.zeros(seedSeq.shape[2]))
+            output.append(np.zeros((seedSeq.shape[0], seedSeq.shape[2])))
             seq_len += 1
 
     #The generation algorithm is simple:
@@ -22,29 +36,75 @@ def generate_from_seed(model, seed, max_seq_len, include_raw_seed=False, include
     #Step 3 - Repeat MAX_SEQ_LEN times
     gen_itr = 0
     while seq_len + gen_itr < max_seq_len:
-        seedSeqNew = model.predict(seedSeq) #Step 1. Generate X_n + 1
+        with timer('generate.step', items=seeds.shape[0]):
+            seedSeqNew = model.predict(seedSeq) #Step 1. Generate X_n + 1
         #Step 2. Append it to the sequence
         if gen_itr == 0 and include_model_seed:
             for i in xrange(seedSeqNew.shape[1]):
-                output.append(seedSeqNew[0][i].copy())
+                output.append(seedSeqNew[:, i].copy())
                 gen_itr += 1
         else:
-            output.append(seedSeqNew[0][seedSeqNew.shape[1]-1].copy()) 
+            output.append(seedSeqNew[:, seedSeqNew.shape[1]-1].copy())
             gen_itr += 1
-        newSeq = seedSeqNew[0][seedSeqNew.shape[1]-1]
-        newSeq = np.reshape(newSeq, (1, 1, newSeq.shape[0]))
+        newSeq = seedSeqNew[:, seedSeqNew.shape[1]-1:]
         # newSeq += np.random.randn(*newSeq.shape)*0.01
         seedSeq = np.concatenate((seedSeq, newSeq), axis=1)
 
+    return split_batch_output(output, seeds.shape[0], uncenter_data, data_variance, data_mean)
+
+# Batched version of generate_from_seed_incremental. The stepper is reset to the batch size of 'seeds'.
+def generate_batch_from_seed_incremental(stepper, seeds, max_seq_len, include_raw_seed=False, include_model_seed=False, uncenter_data=False, data_variance=[], data_mean=[]):
+    output = list(iterate_batch_from_seed_incremental(stepper, seeds, max_seq_len, include_raw_seed, include_model_seed))
+    return split_batch_output(output, seeds.shape[0], uncenter_data, data_variance, data_mean)
+
+# Generator version of generate_batch_from_seed_incremental: yields each (num_songs, num_frequency_dims) step of the
+# output as soon as it is generated, instead of collecting the whole songs. The yielded steps are not uncentered.
+def iterate_batch_from_seed_incremental(stepper, seeds, max_seq_len, include_raw_seed=False, include_model_seed=False):
+    seq_len = 0
+    if include_raw_seed:
+        for i in xrange(seeds.shape[1]):
+            yield seeds[:, i].copy()
+            seq_len += 1
+        for i in xrange(10):
+            yield np.zeros((seeds.shape[0], seeds.shape[2]))
+            seq_len += 1
+
+    gen_itr = 0
+    if seq_len < max_seq_len:
+        #Prime the network state with the seed. The prediction for each seed block is the model's
+        #reproduction of the seed, and the last one is the first newly generated block.
+        stepper.reset(batch_size=seeds.shape[0])
+        for i in xrange(seeds.shape[1]):
+            with timer('generate.prime_step', items=seeds.shape[0]):
+                newSeq = stepper.step(seeds[:, i])
+            if include_model_seed:
+                yield newSeq.copy()
+                gen_itr += 1
+        if not include_model_seed:
+            yield newSeq.copy()
+            gen_itr += 1
+    while seq_len + gen_itr < max_seq_len:
+        with timer('generate.step', items=seeds.shape[0]):
+            newSeq = stepper.step(newSeq)
+        yield newSeq.copy()
+        gen_itr += 1
+
+# Turns a list of (num_songs, num_frequency_dims) steps into one list of blocks per song
+def split_batch_output(output, num_songs, uncenter_data=False, data_variance=[], data_mean=[]):
+    songs = [[step[n] for step in output] for n in xrange(num_songs)]
     if uncenter_data:
-        assert len(data_variance) > 0
-        assert len(data_mean) > 0
-        # Finally, post-process the generated sequence so that we have valid frequencies
-        # We're essentially just undo-ing the data centering process
-        for i in xrange(len(output)):
-            output[i] *= data_variance
-            output[i] += data_mean
-            
+        for song in songs:
+            uncenter_output(song, data_variance, data_mean)
+    return songs
+
+# Post-process a generated sequence so that we have valid frequencies
+# We're essentially just undo-ing the data centering process
+def uncenter_output(output, data_variance, data_mean):
+    assert len(data_variance) > 0
+    assert len(data_mean) > 0
+    for i in xrange(len(output)):
+        output[i] *= data_variance
+        output[i] += data_mean
     return output
     
 
@@ -2,15 +2,21 @@ from __future__ import absolute_import
 from __future__ import print_function
 import numpy as np
 import os
-import nn_utils.network_utils as network_utils
 import gen_utils.seed_generator as seed_generator
 import gen_utils.sequence_generator as sequence_generator
+from gen_utils.seed_index import SEED_MODES, load_or_build_seed_index
 from data_utils.parse_files import *
+from data_utils.sharded_dataset import load_dataset
 import config.nn_config as nn_config
+import perf_utils.instrumentation as instrumentation
 import argparse
 
 # Generate a new sequence using the given model, seed dataset, and generation parameters.
-def generate(model, x_data, max_seq_len, seed_len=1, gen_count=1, include_raw_seed=False, include_model_seed=False, uncenter_data=False, X_var=None, X_mean=None):
+# model only needs a predict method, so it can be a Keras model or a numpy_engine.NumpyLSTMModel.
+# If a stepper (e.g. network_utils.LSTMStepper or numpy_engine.NumpyLSTMStepper) is given, blocks are generated incrementally instead of re-running the model over the whole sequence each step.
+# All gen_count songs advance together as one batch; max_batch caps how many are generated at once to bound memory.
+# seeds are picked at random from x_data unless given (see seed_generator.generate_indexed_seed_sequences).
+def generate(model, x_data, max_seq_len, seed_len=1, gen_count=1, include_raw_seed=False, include_model_seed=False, uncenter_data=False, X_var=None, X_mean=None, stepper=None, max_batch=None, seeds=None):
     print ('Starting generation!')
     #Here's the interesting part
     #We need to create some seed sequence for the algorithm to start with
@@ -19,15 +25,93 @@ def generate(model, x_data, max_seq_len, seed_len=1, gen_count=1, include_raw_se
     #In a sense, choosing good seed sequences = how you get interesting compositions
     #There are many, many ways we can pick these seed sequences such as taking linear combinations of certain songs
     #We could even provide a uniformly random sequence, but that is highly unlikely to produce good results
+    if seeds is None:
+        seeds = seed_generator.generate_copy_seed_sequences(seed_length=seed_len, training_data=x_data, count=gen_count)
+    if max_batch is None or max_batch < 1:
+        max_batch = max(gen_count, 1) #At least 1, so gen_count=0 just generates nothing
     outputs = []
-    for i in range(gen_count):
-        print("Generating sample {0}/{1}".format(i+1, gen_count))
-        seed_seq = seed_generator.generate_copy_seed_sequence(seed_length=seed_len, training_data=x_data)
-        output = sequence_generator.generate_from_seed(model, seed_seq, max_seq_len, include_raw_seed, include_model_seed, uncenter_data, X_var, X_mean)
-        outputs.append(output)
+    for start in range(0, gen_count, max_batch):
+        end = min(start + max_batch, gen_count)
+        print("Generating samples {0}-{1}/{2}".format(start+1, end, gen_count))
+        if stepper is not None:
+            batch_outputs = sequence_generator.generate_batch_from_seed_incremental(stepper, seeds[start:end], max_seq_len, include_raw_seed, include_model_seed, uncenter_data, X_var, X_mean)
+        else:
+            batch_outputs = sequence_generator.generate_batch_from_seed(model, seeds[start:end], max_seq_len, include_raw_seed, include_model_seed, uncenter_data, X_var, X_mean)
+        outputs.extend(batch_outputs)
     return np.array(outputs)
     print('Finished generation!')
-    
+
+# Streaming version of generate: each generated block is uncentered, converted to audio and appended to the song's
+# WAV file (filenames[i] for song i) as soon as the stepper produces it, so memory use doesn't grow with max_seq_len.
+# Always generates incrementally, since the whole-sequence path only has the songs once they are complete.
+def generate_to_wav(stepper, x_data, max_seq_len, filenames, seed_len=1, include_raw_seed=False, include_model_seed=False, X_var=None, X_mean=None, max_batch=None, useTimeDomain=False, sample_frequency=44100, feature_format='fft', seeds=None):
+    print ('Starting generation!')
+    gen_count = len(filenames)
+    if seeds is None:
+        seeds = seed_generator.generate_copy_seed_sequences(seed_length=seed_len, training_data=x_data, count=gen_count)
+    if max_batch is None or max_batch < 1:
+        max_batch = max(gen_count, 1) #At least 1, so gen_count=0 just generates nothing
+    for start in range(0, gen_count, max_batch):
+        end = min(start + max_batch, gen_count)
+        print("Generating samples {0}-{1}/{2}".format(start+1, end, gen_count))
+        writers = [GeneratedExampleWriter(filename, useTimeDomain, sample_frequency, feature_format, X_var, X_mean) for filename in filenames[start:end]]
+        try:
+            for step in sequence_generator.iterate_batch_from_seed_incremental(stepper, seeds[start:end], max_seq_len, include_raw_seed, include_model_seed):
+                for writer, block in zip(writers, step):
+                    writer.write_block(block)
+        finally:
+            for writer in writers:
+                writer.close()
+    print('Finished generation!')
+
+# Loads the generator whose weights are in model_filename, either as a Keras model or (if use_numpy) with the NumPy engine,
+# optionally with int8 quantized weights. The NumPy weights are exported/quantized next to model_filename on first use.
+def load_generator(model_filename, freq_space_dims, hidden_dims, use_numpy=False, quantized=False):
+    if use_numpy:
+        #The NumPy engine needs neither Keras nor TensorFlow
+        from nn_utils.numpy_engine import export_weights, load_numpy_model
+        numpy_filename = model_filename + '.npz'
+        if not os.path.isfile(numpy_filename) or (os.path.isfile(model_filename) and os.path.getmtime(model_filename) > os.path.getmtime(numpy_filename)):
+            print('Exporting weights from {0} to {1}'.format(model_filename, numpy_filename))
+            export_weights(model_filename, numpy_filename)
+        if quantized:
+            from nn_utils.quantization import quantize_model_file
+            float_filename = numpy_filename
+            numpy_filename = model_filename + '.int8.npz'
+            if not os.path.isfile(numpy_filename) or os.path.getmtime(float_filename) > os.path.getmtime(numpy_filename):
+                print('Quantizing weights from {0} to {1}'.format(float_filename, numpy_filename))
+                quantize_model_file(float_filename, numpy_filename)
+        print('Loading weights from file {0}'.format(numpy_filename))
+        model = load_numpy_model(numpy_filename)
+        assert model.num_frequency_dimensions == freq_space_dims
+    else:
+        import nn_utils.network_utils as network_utils
+        #Creates a lstm network
+        print('Initializing network...')
+        model = network_utils.create_lstm_network(num_frequency_dimensions=freq_space_dims, num_hidden_dimensions=hidden_dims)
+        #model = network_utils.create_noise_network(num_frequency_dimensions=freq_space_dims, num_hidden_dimensions=hidden_dims)
+        #You could also substitute this with a RNN or GRU
+        #model = network_utils.create_gru_network()
+
+        print('Model summary:')
+        model.summary()
+
+        #Load existing weights if available
+        if os.path.isfile(model_filename):
+            print('Loading weights from file {0}'.format(model_filename))
+            model.load_weights(model_filename)
+        else:
+            print('Model filename ' + model_filename + ' could not be found!')
+    return model
+
+# Incremental stepper for a model returned by load_generator
+def create_stepper(model, use_numpy=False):
+    if use_numpy:
+        from nn_utils.numpy_engine import NumpyLSTMStepper
+        return NumpyLSTMStepper(model)
+    import nn_utils.network_utils as network_utils
+    return network_utils.LSTMStepper(model)
+
 def __main__():
     config = nn_config.get_neural_net_configuration()
     parser = argparse.ArgumentParser(description="Generate song from current saved training data.")
@@ -39,7 +123,16 @@ def __main__():
     parser.add_argument("--output", default='new', type=str, help="Either 'new' (default) for only new generated output, 'gen' to also include the model's reproduction of the seed, or 'all' to also include the raw seed sequence.")
     parser.add_argument("-r", "--run", default=0, type=int, help="Integer id for this run (used for weight files). Defaults to zero.")
     parser.add_argument("--hidden-dims", default=config['hidden_dimension_size'], type=int, help="Number of hidden layer dimensions.")
+    parser.add_argument("--max-gen-batch", default=0, type=int, help="Maximum number of songs to generate at once. Defaults to all of them.")
+    parser.add_argument("--incremental", action='store_true', default=False, help="Generate one block at a time, carrying the network state between steps instead of re-running the whole sequence.")
+    parser.add_argument("--numpy", action='store_true', default=False, help="Run the network with the NumPy inference engine instead of Keras/TensorFlow. The weights are exported to <weights file>.npz on first use, which needs h5py.")
+    parser.add_argument("--quantized", action='store_true', default=False, help="With --numpy, use int8 quantized weights (<weights file>.int8.npz, created on first use; see quantize_model.py).")
+    parser.add_argument("--seed-mode", default='random', choices=SEED_MODES, help="How to pick the seeds: 'random' (default) training examples, the ones most 'similar' or 'dissimilar' to --seed-reference, or a 'diverse' set spread over the library. All but 'random' use a seed index stored next to the dataset, built on first use.")
+    parser.add_argument("--seed-reference", default=None, type=str, help="WAV file to compare examples against for --seed-mode similar/dissimilar. Defaults to a random training example.")
+    parser.add_argument("--stream", action='store_true', default=False, help="Write each block to the output WAV files as soon as it is generated, with constant memory use however long the songs are. Implies --incremental.")
+    instrumentation.add_arguments(parser)
     args = parser.parse_args()
+    instrumentation.setup(args)
 
     sample_frequency = config['sampling_frequency']
     if args.dataset == 'train':
@@ -59,44 +152,51 @@ def __main__():
         print('Loading training data')
     else:
         print('Loading generation data')
-    #X_train is a tensor of size (num_train_examples, num_timesteps, num_frequency_dims)
-    #y_train is a tensor of size (num_train_examples, num_timesteps, num_frequency_dims)
+    #X_train is a tensor of size (num_train_examples, num_timesteps, num_frequency_dims), memory-mapped so only the seeds are read from disk
     #X_mean is a matrix of size (num_frequency_dims,) containing the mean for each frequency dimension
     #X_var is a matrix of size (num_frequency_dims,) containing the variance for each frequency dimension
-    X_train = np.load(inputFile + '_x.npy')
-    y_train = np.load(inputFile + '_y.npy')
+    X_train, y_train = load_dataset(inputFile)
     X_mean = np.load(inputFile + '_mean.npy')
     X_var = np.load(inputFile + '_var.npy')
+    dataset_info = load_dataset_info(inputFile)
     print('Finished loading data')
     
     #Figure out how many frequencies we have in the data
     num_timesteps = X_train.shape[1]
     freq_space_dims = X_train.shape[2]
     hidden_dims = args.hidden_dims
+    print('Feature format: {0} ({1} frequency dimensions)'.format(dataset_info['feature_format'], freq_space_dims))
 
-    #Creates a lstm network
-    print('Initializing network...')
-    model = network_utils.create_lstm_network(num_frequency_dimensions=freq_space_dims, num_hidden_dimensions=hidden_dims)
-    #model = network_utils.create_noise_network(num_frequency_dimensions=freq_space_dims, num_hidden_dimensions=hidden_dims)
-    #You could also substitute this with a RNN or GRU
-    #model = network_utils.create_gru_network()
+    model = load_generator(model_filename, freq_space_dims, hidden_dims, args.numpy, args.quantized)
 
-    print('Model summary:')
-    model.summary()
+    seq_len = args.seqlen; #Defines how long the final generated song is. Total song length in samples = seq_len * example_len
 
-    #Load existing weights if available
-    if os.path.isfile(model_filename):
-        print('Loading weights from file {0}'.format(model_filename))
-        model.load_weights(model_filename)
-    else:
-        print('Model filename ' + model_filename + ' could not be found!')
+    seeds = None
+    if args.seed_mode != 'random':
+        index = load_or_build_seed_index(inputFile, X_train)
+        reference = None
+        if args.seed_reference is not None:
+            block_size = dataset_info.get('block_size', sample_frequency // 4)
+            features = load_track_features(args.seed_reference, block_size, useTimeDomain=dataset_info['useTimeDomain'], feature_format=dataset_info['feature_format'])
+            reference = index.embed(((features - X_mean) / X_var)[np.newaxis])[0]
+        seeds = seed_generator.generate_indexed_seed_sequences(args.seedlen, X_train, gen_count, index, args.seed_mode, reference)
 
-    seq_len = args.seqlen; #Defines how long the final generated song is. Total song length in samples = seq_len * example_len
+    stepper = None
+    if args.incremental or args.stream:
+        stepper = create_stepper(model, args.numpy)
+
+    if args.stream:
+        filenames = ['{0}_{1}.wav'.format(output_filename, i) for i in xrange(gen_count)]
+        generate_to_wav(stepper, X_train, seq_len, filenames, seed_len=args.seedlen, include_raw_seed=include_raw_seed, include_model_seed=include_model_seed, X_var=X_var, X_mean=X_mean, max_batch=args.max_gen_batch, useTimeDomain=dataset_info['useTimeDomain'], sample_frequency=sample_frequency, feature_format=dataset_info['feature_format'], seeds=seeds)
+        instrumentation.finish()
+        return
 
-    outputs = generate(model, X_train, seq_len, seed_len=args.seedlen, gen_count=gen_count, include_raw_seed=include_raw_seed, include_model_seed=include_model_seed, uncenter_data=True, X_var=X_var, X_mean=X_mean)
+    outputs = generate(model, X_train, seq_len, seed_len=args.seedlen, gen_count=gen_count, include_raw_seed=include_raw_seed, include_model_seed=include_model_seed, uncenter_data=True, X_var=X_var, X_mean=X_mean, stepper=stepper, max_batch=args.max_gen_batch, seeds=seeds)
     for i in xrange(gen_count):
         #Save the generated sequence to a WAV file
-        save_generated_example('{0}_{1}.wav'.format(output_filename, i), outputs[i], sample_frequency=sample_frequency)
+        with instrumentation.timer('generate.save_wav', items=len(outputs[i])):
+            save_generated_example('{0}_{1}.wav'.format(output_filename, i), outputs[i], useTimeDomain=dataset_info['useTimeDomain'], sample_frequency=sample_frequency, feature_format=dataset_info['feature_format'])
+    instrumentation.finish()
         
 if __name__ == '__main__':
     __main__()
@@ -0,0 +1,126 @@
+from __future__ import print_function
+import os
+import json
+import numpy as np
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+from data_utils.parse_files import load_dataset_info
+from data_utils.sharded_dataset import load_dataset
+from gen_utils.generation_service import ModelCache, GenerationRequest, GenerationService
+from generate import load_generator, create_stepper
+import config.nn_config as nn_config
+import argparse
+
+# Long-running local generation server. The seed dataset and normalization statistics are loaded once, the most
+# recently used weight sets stay loaded (see --cache-size), and concurrent requests are generated together in shared
+# batches (see gen_utils/generation_service.py), so a request only costs its share of the generation itself.
+#
+#   POST /generate  JSON body {"run": 0, "iteration": 0, "seqlen": 10, "seedlen": 1, "output": "new"}, all optional
+#                   (same meaning and defaults as generate.py's flags). Responds with the generated song as audio/wav.
+#   GET  /status    JSON with queue, batching and model cache statistics
+
+OUTPUT_MODES = ('new', 'gen', 'all')
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class GenerationHandler(BaseHTTPRequestHandler):
+    def send_json(self, code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self.send_json(200, self.server.service.status())
+        else:
+            self.send_json(404, {'error': 'Unknown path ' + self.path})
+
+    def do_POST(self):
+        if self.path != '/generate':
+            self.send_json(404, {'error': 'Unknown path ' + self.path})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            params = json.loads(self.rfile.read(length).decode('utf-8')) if length > 0 else {}
+            output = params.get('output', 'new')
+            if output not in OUTPUT_MODES:
+                raise ValueError('output must be one of ' + ', '.join(OUTPUT_MODES))
+            request = GenerationRequest((int(params.get('run', 0)), int(params.get('iteration', 0))),
+                                        seq_len=int(params.get('seqlen', 10)), seed_len=int(params.get('seedlen', 1)),
+                                        include_raw_seed=output == 'all', include_model_seed=output in ('gen', 'all'))
+            if request.seq_len < 1 or request.seed_len < 1:
+                raise ValueError('seqlen and seedlen must be positive')
+        except (ValueError, TypeError, AttributeError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        try:
+            wav = self.server.service.generate(request, self.server.timeout_seconds)
+        except IOError as e:
+            self.send_json(404, {'error': str(e)})
+            return
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/wav')
+        self.send_header('Content-Length', str(len(wav)))
+        self.end_headers()
+        self.wfile.write(wav)
+
+def __main__():
+    config = nn_config.get_neural_net_configuration()
+    parser = argparse.ArgumentParser(description="Serve song generation over HTTP, keeping models and data loaded between requests.")
+    parser.add_argument("--host", default='127.0.0.1', type=str, help="Address to listen on. Defaults to localhost only.")
+    parser.add_argument("--port", default=8000, type=int, help="Port to listen on.")
+    parser.add_argument("--dataset", default='train', type=str, help='The dataset to draw seeds from. Defaults to "train".')
+    parser.add_argument("--hidden-dims", default=config['hidden_dimension_size'], type=int, help="Number of hidden layer dimensions.")
+    parser.add_argument("--numpy", action='store_true', default=False, help="Run the network with the NumPy inference engine instead of Keras/TensorFlow (see generate.py).")
+    parser.add_argument("--quantized", action='store_true', default=False, help="With --numpy, use int8 quantized weights.")
+    parser.add_argument("--cache-size", default=2, type=int, help="Number of weight sets (run, iteration pairs) kept loaded. The least recently used one is dropped first.")
+    parser.add_argument("--max-batch", default=16, type=int, help="Maximum number of requests generated together.")
+    parser.add_argument("--batch-window", default=0.01, type=float, help="Seconds to wait for other requests to join a batch before starting it.")
+    parser.add_argument("--timeout", default=600.0, type=float, help="Seconds a request may take before it fails.")
+    args = parser.parse_args()
+
+    sample_frequency = config['sampling_frequency']
+    inputFile = config['model_file'] if args.dataset == 'train' else config['gen_file']
+    print('Loading seed data from {0}'.format(inputFile))
+    X_train, y_train = load_dataset(inputFile)
+    X_mean = np.load(inputFile + '_mean.npy')
+    X_var = np.load(inputFile + '_var.npy')
+    dataset_info = load_dataset_info(inputFile)
+    freq_space_dims = X_train.shape[2]
+
+    def load_stepper(key):
+        run, iteration = key
+        model_filename = config['model_basename'] + str(run) + '_' + str(iteration)
+        exported = os.path.isfile(model_filename + '.npz') or os.path.isfile(model_filename + '.int8.npz')
+        if not os.path.isfile(model_filename) and not (args.numpy and exported):
+            raise IOError('No weights for run {0} iteration {1} ({2})'.format(run, iteration, model_filename))
+        model = load_generator(model_filename, freq_space_dims, args.hidden_dims, args.numpy, args.quantized)
+        return create_stepper(model, args.numpy)
+
+    service = GenerationService(ModelCache(load_stepper, args.cache_size), X_train, X_var, X_mean, dataset_info, sample_frequency, args.max_batch, args.batch_window)
+    service.start()
+    server = ThreadingHTTPServer((args.host, args.port), GenerationHandler)
+    server.service = service
+    server.timeout_seconds = args.timeout
+    print('Serving on http://{0}:{1}/'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+
+if __name__ == '__main__':
+    __main__()
@@ -0,0 +1,197 @@
+import os
+import re
+import threading
+import numpy as np
+
+# Keras and h5py are imported where they're used, so scripts can import this module without loading them at startup
+
+# Suffix of the file holding a model's optimizer state next to its weights file
+OPTIMIZER_SUFFIX = '.optimizer.npz'
+
+# Copies a model's weights to host memory, laid out the way Keras' save_weights stores them.
+# Returns a list of (layer_name, [(weight_name, value), ...]).
+def snapshot_weights(model):
+    from keras import backend as K
+    weights = [w for layer in model.layers for w in layer.weights]
+    values = K.batch_get_value(weights)
+    snapshot = []
+    i = 0
+    for layer in model.layers:
+        layer_weights = []
+        for w in layer.weights:
+            layer_weights.append((str(w.name), values[i]))
+            i += 1
+        snapshot.append((layer.name, layer_weights))
+    return snapshot
+
+# Writes a snapshot_weights() snapshot as an HDF5 file that model.load_weights can read
+def write_weights(filename, snapshot):
+    import h5py
+    import keras
+    from keras import backend as K
+    with h5py.File(filename, 'w') as f:
+        # Fixed-length byte strings, as written by Keras itself
+        f.attrs['layer_names'] = np.asarray([name.encode('utf8') for name, layer_weights in snapshot])
+        f.attrs['backend'] = np.bytes_(K.backend().encode('utf8'))
+        f.attrs['keras_version'] = np.bytes_(str(keras.__version__).encode('utf8'))
+        for name, layer_weights in snapshot:
+            g = f.create_group(name)
+            g.attrs['weight_names'] = np.asarray([weight_name.encode('utf8') for weight_name, value in layer_weights])
+            for weight_name, value in layer_weights:
+                dset = g.create_dataset(weight_name, value.shape, dtype=value.dtype)
+                if value.shape:
+                    dset[:] = value
+                else:
+                    dset[()] = value
+
+# Copies a compiled model's optimizer state (e.g. RMSprop accumulators) to host memory.
+# Empty until the model has been trained at least once.
+def snapshot_optimizer(model):
+    if getattr(model, 'optimizer', None) is None:
+        return []
+    return model.optimizer.get_weights()
+
+def write_optimizer(filename, values):
+    with open(filename, 'wb') as f:
+        np.savez(f, *values)
+
+# Restores optimizer state written by write_optimizer. Returns False if it doesn't match the model's optimizer.
+def load_optimizer(model, filename):
+    data = np.load(filename)
+    values = [data['arr_%d' % i] for i in range(len(data.files))]
+    if len(values) == 0:
+        return True
+    if len(model.optimizer.weights) == 0:
+        # Keras only creates an optimizer's weights when it builds the model's training function, on the first fit,
+        # and has no public call that does it earlier. keras.models.load_model restores optimizer state the same way.
+        model._make_train_function()
+    if len(values) != len(model.optimizer.weights):
+        return False
+    model.optimizer.set_weights(values)
+    return True
+
+# Writes data to filename through a temporary file that is renamed into place, so filename is either
+# absent or complete, even if the process dies mid-write
+def atomic_write(filename, write, data):
+    tmp_filename = filename + '.tmp'
+    write(tmp_filename, data)
+    os.rename(tmp_filename, filename)
+
+# Saves and restores training checkpoints made of one or more models (e.g. a GAN's generator and decoder).
+# members is a list of (basename, model); the weights of a model for a given iteration are stored in
+# basename + str(iteration), as before, and its optimizer state next to them.
+# optimizer_members is a list of (basename, model) of which only the optimizer state is saved, for compiled models
+# whose weights are all shared with members (e.g. a GAN's combined model, which has its own optimizer).
+#
+# save() only copies the weights to host memory on the calling thread; the files are written by a background
+# thread, each through a temporary file that is atomically renamed into place. A checkpoint counts as complete
+# once all members' weights files exist, which is what latest() looks for, so a crash never yields a truncated
+# checkpoint to resume from.
+#
+# After every save, checkpoints are pruned down to the keep_last most recent ones plus every iteration that
+# is a multiple of keep_every (if set).
+class CheckpointManager:
+    def __init__(self, members, keep_last=2, keep_every=None, save_optimizer=True, optimizer_members=None):
+        self.members = members
+        self.optimizer_members = optimizer_members or []
+        self.keep_last = max(keep_last, 1)
+        self.keep_every = keep_every
+        self.save_optimizer = save_optimizer
+        self.thread = None
+        self.error = None
+
+    def weights_filename(self, basename, iteration):
+        return basename + str(iteration)
+
+    def optimizer_filename(self, basename, iteration):
+        return basename + str(iteration) + OPTIMIZER_SUFFIX
+
+    def is_complete(self, iteration):
+        return all(os.path.isfile(self.weights_filename(basename, iteration)) for basename, model in self.members)
+
+    # Iterations with a complete checkpoint on disk, in increasing order
+    def iterations(self):
+        basename = self.members[0][0]
+        directory = os.path.dirname(basename) or '.'
+        pattern = re.compile('^' + re.escape(os.path.basename(basename)) + r'(\d+)$')
+        found = []
+        for file in os.listdir(directory):
+            match = pattern.match(file)
+            if match is not None and self.is_complete(int(match.group(1))):
+                found.append(int(match.group(1)))
+        return sorted(found)
+
+    # The most recent complete checkpoint, or None if there is none
+    def latest(self):
+        found = self.iterations()
+        return found[-1] if found else None
+
+    # Loads the weights (and optimizer state, if saved) of the given iteration into the member models
+    def restore(self, iteration):
+        self.wait()
+        for basename, model in self.members:
+            print('Loading existing weight data from {0}'.format(self.weights_filename(basename, iteration)))
+            model.load_weights(self.weights_filename(basename, iteration))
+        for basename, model in self.members + self.optimizer_members:
+            optimizer_filename = self.optimizer_filename(basename, iteration)
+            if os.path.isfile(optimizer_filename) and not load_optimizer(model, optimizer_filename):
+                print('Warning: optimizer state in {0} does not match the model, starting with a fresh optimizer'.format(optimizer_filename))
+
+    # Snapshots all members and writes them in the background. Waits for the previous save to finish first,
+    # so at most one checkpoint is in flight.
+    def save(self, iteration):
+        snapshots = []
+        for basename, model in self.members:
+            optimizer_state = snapshot_optimizer(model) if self.save_optimizer else None
+            snapshots.append((basename, snapshot_weights(model), optimizer_state))
+        if self.save_optimizer:
+            for basename, model in self.optimizer_members:
+                snapshots.append((basename, None, snapshot_optimizer(model)))
+        self.wait()
+        self.thread = threading.Thread(target=self.write, args=(iteration, snapshots))
+        self.thread.start()
+
+    def write(self, iteration, snapshots):
+        try:
+            # Optimizer state first, so a checkpoint is never complete without it
+            for basename, weights, optimizer_state in snapshots:
+                if optimizer_state is not None:
+                    atomic_write(self.optimizer_filename(basename, iteration), write_optimizer, optimizer_state)
+            for basename, weights, optimizer_state in snapshots:
+                if weights is not None:
+                    atomic_write(self.weights_filename(basename, iteration), write_weights, weights)
+            self.prune()
+        except Exception as e:
+            self.error = e
+
+    def retained(self, iterations):
+        keep = set(iterations[-self.keep_last:])
+        if self.keep_every:
+            keep.update(i for i in iterations if i % self.keep_every == 0)
+        return keep
+
+    def prune(self):
+        found = self.iterations()
+        keep = self.retained(found)
+        for iteration in found:
+            if iteration in keep:
+                continue
+            # Weights first, so a half-deleted checkpoint is no longer complete
+            for basename, model in self.members:
+                filename = self.weights_filename(basename, iteration)
+                if os.path.isfile(filename):
+                    os.remove(filename)
+            for basename, model in self.members + self.optimizer_members:
+                filename = self.optimizer_filename(basename, iteration)
+                if os.path.isfile(filename):
+                    os.remove(filename)
+
+    # Blocks until the pending save (if any) is on disk, re-raising any error it hit
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
@@ -1,9 +1,48 @@
 from keras.models import *
 from keras.layers import *
 from keras import optimizers
+from keras import backend as K
+from keras.utils import Sequence
+import tensorflow as tf
 import numpy as np
 
-def create_lstm_network(num_frequency_dimensions, num_hidden_dimensions, optimizer='rmsprop', dropout_rate=0.3):
+# Registers a TensorFlow session with Keras if any of TensorFlow's defaults need changing. log_device_placement logs
+# the device each op runs on; threads limits TensorFlow's thread pools, e.g. when several trainings share a machine.
+def configure_session(threads=0, log_device_placement=False):
+    if threads <= 0 and not log_device_placement:
+        return
+    config = tf.ConfigProto(log_device_placement=log_device_placement)
+    if threads > 0:
+        config.intra_op_parallelism_threads = threads
+        config.inter_op_parallelism_threads = 1
+    K.set_session(tf.Session(config=config))
+
+# keras.utils.Sequence over a data_utils.batch_loader loader, for model.fit_generator. Keras' enqueuer then assembles
+# batches ahead of training on worker threads (reading memory-mapped data releases the GIL, so threads are enough) and
+# calls on_epoch_end between its own epochs, so every epoch sees every example exactly once.
+class LoaderSequence(Sequence):
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getitem__(self, idx):
+        return self.loader[idx]
+
+    def on_epoch_end(self):
+        self.loader.on_epoch_end()
+
+# LoaderSequence over a loader serving x batches only, paired with the 'real' label the GAN's combined model is trained towards
+class RealLabelSequence(LoaderSequence):
+    def __getitem__(self, idx):
+        x = self.loader[idx]
+        return x, np.ones(x.shape[:2] + (1,), dtype='float32')
+
+# Pass sample_weight_mode='temporal' to train on zero-padded variable-length batches with a per-timestep mask as sample weights
+# (see data_utils.batch_loader.BucketBatchLoader): padded timesteps then don't contribute to the loss. Padding goes at the end of
+# each sequence and every layer is causal, so it doesn't affect the outputs for the real timesteps either.
+def create_lstm_network(num_frequency_dimensions, num_hidden_dimensions, optimizer='rmsprop', dropout_rate=0.3, sample_weight_mode=None):
     inputs = Input(shape=(None, num_frequency_dimensions))
     #td_input = TimeDistributed(Dense(num_hidden_dimensions))(inputs)
     
@@ -24,9 +63,54 @@ def create_lstm_network(num_frequency_dimensions, num_hidden_dimensions, optimiz
     # Convert back to frequency space
     #td_output = TimeDistributed(Dense(num_frequency_dimensions))(lstm_2)
     model = Model(inputs=inputs, outputs=conv_out)
-    model.compile(loss='logcosh', optimizer=optimizer)
+    model.compile(loss='logcosh', optimizer=optimizer, sample_weight_mode=sample_weight_mode)
     return model
 
+# Single-timestep twin of create_lstm_network used for incremental generation.
+# The causal convolutions (kernel_size=2) are fed an explicit (previous, current) window and the LSTM state
+# is passed in and out explicitly, so every generated block costs O(1) instead of re-running the whole sequence.
+def create_lstm_step_network(num_frequency_dimensions, num_hidden_dimensions):
+    x_window = Input(shape=(2, num_frequency_dimensions))
+    lstm_prev = Input(shape=(1, num_hidden_dimensions))
+    state_h = Input(shape=(num_hidden_dimensions,))
+    state_c = Input(shape=(num_hidden_dimensions,))
+    conv_in = Conv1D(num_hidden_dimensions, kernel_size=2, activation='tanh', padding='valid')(x_window)
+    lstm_1, new_h, new_c = LSTM(num_hidden_dimensions, return_sequences=True, return_state=True)(conv_in, initial_state=[state_h, state_c])
+    lstm_window = Concatenate(axis=1)([lstm_prev, lstm_1])
+    conv_out = Conv1D(num_frequency_dimensions, kernel_size=2, activation='tanh', padding='valid')(lstm_window)
+    return Model(inputs=[x_window, lstm_prev, state_h, state_c], outputs=[conv_out, lstm_1, new_h, new_c])
+
+# Steps a trained create_lstm_network model forward one block at a time.
+# Keeps the LSTM hidden/cell state and the last input/LSTM output needed by the causal convolutions.
+class LSTMStepper:
+    def __init__(self, model):
+        convs = [layer for layer in model.layers if isinstance(layer, Conv1D)]
+        lstms = [layer for layer in model.layers if isinstance(layer, LSTM)]
+        assert len(convs) == 2 and len(lstms) == 1
+        self.num_frequency_dimensions = convs[1].filters
+        self.num_hidden_dimensions = lstms[0].units
+        self.step_model = create_lstm_step_network(self.num_frequency_dimensions, self.num_hidden_dimensions)
+        step_convs = [layer for layer in self.step_model.layers if isinstance(layer, Conv1D)]
+        step_lstms = [layer for layer in self.step_model.layers if isinstance(layer, LSTM)]
+        for src, dst in zip(convs + lstms, step_convs + step_lstms):
+            dst.set_weights(src.get_weights())
+        self.reset()
+
+    # Clears the carried state, as if starting a new sequence
+    def reset(self, batch_size=1):
+        self.prev_x = np.zeros((batch_size, self.num_frequency_dimensions), dtype='float32')
+        self.prev_lstm = np.zeros((batch_size, 1, self.num_hidden_dimensions), dtype='float32')
+        self.state_h = np.zeros((batch_size, self.num_hidden_dimensions), dtype='float32')
+        self.state_c = np.zeros((batch_size, self.num_hidden_dimensions), dtype='float32')
+
+    # Feeds one block of shape (batch_size, num_frequency_dimensions) and returns the prediction for the next one
+    def step(self, x):
+        x_window = np.stack((self.prev_x, x), axis=1)
+        y, lstm_out, self.state_h, self.state_c = self.step_model.predict_on_batch([x_window, self.prev_lstm, self.state_h, self.state_c])
+        self.prev_x = x
+        self.prev_lstm = lstm_out
+        return y[:, 0]
+
 def create_gru_network(num_frequency_dimensions, num_hidden_dimensions, num_recurrent_units=1, optimizer='rmsprop', dropout_rate=0.3):
     model = Sequential()
     #This layer converts frequency space to hidden space
@@ -77,7 +161,15 @@ class GAN:
         return self.generator.fit(X_train, y_train, batch_size=batch_size, epochs=epochs, shuffle=shuffle, verbose=verbose, validation_data=validation_data)
     
     # Fit the decoder network against the given real and fake X examples. An example output of '1' will be generated for each real example, and '0' for each fake one.
-    def fit_decoder(self, X_real, X_fake, batch_size=None, epochs=10, shuffle=False, verbose=1, validation_split=0.0):
+    # If a replay_buffer (see gen_utils.replay_buffer) is given, the freshly generated X_fake are topped up with previously generated fakes
+    # from it to match the number of real examples, and are then added to it.
+    def fit_decoder(self, X_real, X_fake, batch_size=None, epochs=10, shuffle=False, verbose=1, validation_split=0.0, replay_buffer=None):
+        if replay_buffer is not None:
+            num_cached = min(max(X_real.shape[0] - X_fake.shape[0], 0), len(replay_buffer))
+            X_fresh = X_fake
+            if num_cached > 0:
+                X_fake = np.concatenate((X_fresh, replay_buffer.sample(num_cached)), axis=0)
+            replay_buffer.add(X_fresh)
         num_real = X_real.shape[0]
         num_fake = X_fake.shape[0]
         X_train = np.concatenate((X_real, X_fake), axis=0)
@@ -92,6 +184,20 @@ class GAN:
         hist = self.model.fit(X_train, y_train, batch_size=batch_size, epochs=epochs, shuffle=shuffle, verbose=verbose, validation_split=validation_split)
         self.decoder.trainable = True
         return hist
+
+    # Same as fit, over the batches of a data_utils.batch_loader loader serving x only (and optionally a validation
+    # loader), so examples are read from disk batch by batch instead of being loaded into memory up front
+    def fit_loader(self, loader, epochs=10, verbose=1, val_loader=None, workers=2, max_queue_size=4):
+        val_data = None
+        val_steps = None
+        if val_loader is not None and len(val_loader) > 0:
+            val_data = RealLabelSequence(val_loader)
+            val_steps = len(val_loader)
+        self.decoder.trainable = False
+        hist = self.model.fit_generator(RealLabelSequence(loader), steps_per_epoch=len(loader), epochs=epochs, verbose=verbose, validation_data=val_data, validation_steps=val_steps,
+                                        workers=workers, max_queue_size=max_queue_size, use_multiprocessing=False, shuffle=False)
+        self.decoder.trainable = True
+        return hist
     
     def summary(self):
         print('==== Generator ====')
@@ -0,0 +1,166 @@
+import numpy as np
+
+# Pure NumPy forward pass of the create_lstm_network generator (causal Conv1D -> LSTM -> causal Conv1D), for generating
+# on machines without Keras/TensorFlow. Weights saved by Keras' save_weights are exported once to a compact .npz with
+# export_weights (which only needs h5py); load_numpy_model then only needs NumPy.
+
+NUMPY_MODEL_VERSION = 1
+
+def hard_sigmoid(x):
+    return np.clip(0.2 * x + 0.5, 0.0, 1.0)
+
+def sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+RECURRENT_ACTIVATIONS = {'hard_sigmoid': hard_sigmoid, 'sigmoid': sigmoid}
+
+# Keras' LSTM defaults to a hard sigmoid recurrent activation before Keras 2.3, and to a sigmoid from then on
+def default_recurrent_activation(keras_version):
+    try:
+        major, minor = [int(part) for part in keras_version.split('-')[0].split('.')[:2]]
+    except ValueError:
+        return 'hard_sigmoid'
+    if (major, minor) >= (2, 3):
+        return 'sigmoid'
+    return 'hard_sigmoid'
+
+def decode_attr(value):
+    return value.decode('utf8') if isinstance(value, bytes) else str(value)
+
+# Reads the Conv1D and LSTM weights of a create_lstm_network model from a Keras HDF5 weights file,
+# in layer order: returns ([(kernel, bias), (kernel, bias)], (kernel, recurrent_kernel, bias), keras_version)
+def read_keras_weights(weights_filename):
+    import h5py
+    convs = []
+    lstms = []
+    with h5py.File(weights_filename, 'r') as f:
+        keras_version = decode_attr(f.attrs.get('keras_version', '2.2'))
+        for layer_name in f.attrs['layer_names']:
+            g = f[decode_attr(layer_name)]
+            weights = [np.array(g[decode_attr(name)]) for name in g.attrs['weight_names']]
+            if len(weights) == 2 and weights[0].ndim == 3:
+                convs.append(tuple(weights))
+            elif len(weights) == 3 and weights[1].ndim == 2:
+                lstms.append(tuple(weights))
+            elif len(weights) > 0:
+                raise ValueError('Unexpected layer {0} in {1}'.format(decode_attr(layer_name), weights_filename))
+    if len(convs) != 2 or len(lstms) != 1:
+        raise ValueError('{0} does not hold the weights of a create_lstm_network model'.format(weights_filename))
+    return convs, lstms[0], keras_version
+
+# Exports the weights of a create_lstm_network model saved with save_weights to a .npz file for load_numpy_model
+def export_weights(weights_filename, out_filename, recurrent_activation=None):
+    convs, lstm, keras_version = read_keras_weights(weights_filename)
+    if recurrent_activation is None:
+        recurrent_activation = default_recurrent_activation(keras_version)
+    assert recurrent_activation in RECURRENT_ACTIVATIONS
+    with open(out_filename, 'wb') as f:
+        np.savez(f, version=NUMPY_MODEL_VERSION, recurrent_activation=recurrent_activation,
+                 conv_in_kernel=convs[0][0], conv_in_bias=convs[0][1],
+                 lstm_kernel=lstm[0], lstm_recurrent_kernel=lstm[1], lstm_bias=lstm[2],
+                 conv_out_kernel=convs[1][0], conv_out_bias=convs[1][1])
+
+# x . weights for a float32 matrix or a quantization.QuantizedMatrix
+def matmul(x, weights):
+    if isinstance(weights, np.ndarray):
+        return np.dot(x, weights)
+    return weights.dot(x)
+
+# Causal kernel_size=2 convolution: out[t] = tanh(x[t-1] . kernel[0] + x[t] . kernel[1] + bias), given x[t-1] and x[t]
+def causal_conv_step(prev_x, x, kernel, bias):
+    return np.tanh(matmul(prev_x, kernel[0]) + matmul(x, kernel[1]) + bias)
+
+# Same as causal_conv_step, over whole (batch, timesteps, dims) sequences that start from zeros
+def causal_conv(x, kernel, bias):
+    batch_size, num_timesteps, num_dims = x.shape
+    out = matmul(x.reshape((-1, num_dims)), kernel[1]).reshape((batch_size, num_timesteps, -1))
+    out[:, 1:] += matmul(x[:, :-1].reshape((-1, num_dims)), kernel[0]).reshape((batch_size, num_timesteps - 1, -1))
+    out += bias
+    return np.tanh(out)
+
+# Names of the weight matrices of a model; convolution kernels hold one matrix per tap
+KERNEL_NAMES = ('conv_in_kernel', 'lstm_kernel', 'lstm_recurrent_kernel', 'conv_out_kernel')
+BIAS_NAMES = ('conv_in_bias', 'lstm_bias', 'conv_out_bias')
+
+# Inference-only twin of create_lstm_network. Computes in float32.
+# weights maps the KERNEL_NAMES and BIAS_NAMES to arrays (as saved by export_weights); the kernels may instead be
+# quantization.QuantizedMatrix objects (lists of them for the convolution kernels).
+class NumpyLSTMModel:
+    def __init__(self, weights):
+        for name in KERNEL_NAMES:
+            kernel = weights[name]
+            setattr(self, name, kernel.astype('float32') if isinstance(kernel, np.ndarray) else kernel)
+        for name in BIAS_NAMES:
+            setattr(self, name, weights[name].astype('float32'))
+        self.recurrent_activation = RECURRENT_ACTIVATIONS[str(weights['recurrent_activation'])]
+        self.num_frequency_dimensions = self.conv_out_bias.shape[0]
+        self.num_hidden_dimensions = self.lstm_recurrent_kernel.shape[0]
+
+    # Number of bytes taken by the weights
+    def nbytes(self):
+        total = sum(getattr(self, name).nbytes for name in BIAS_NAMES)
+        for name in KERNEL_NAMES:
+            kernel = getattr(self, name)
+            total += sum(matrix.nbytes for matrix in kernel) if isinstance(kernel, list) else kernel.nbytes
+        return total
+
+    # One LSTM step from precomputed input projections z_x = x . kernel + bias. Keras gate order: input, forget, cell, output.
+    def lstm_step(self, z_x, state_h, state_c):
+        units = self.num_hidden_dimensions
+        z = z_x + matmul(state_h, self.lstm_recurrent_kernel)
+        i = self.recurrent_activation(z[:, :units])
+        f = self.recurrent_activation(z[:, units:2*units])
+        o = self.recurrent_activation(z[:, 3*units:])
+        state_c = f * state_c + i * np.tanh(z[:, 2*units:3*units])
+        state_h = o * np.tanh(state_c)
+        return state_h, state_c
+
+    # Runs the network over (batch, timesteps, num_frequency_dimensions) sequences, like model.predict
+    def predict(self, x):
+        x = np.asarray(x, dtype='float32')
+        batch_size, num_timesteps = x.shape[0], x.shape[1]
+        conv_in = causal_conv(x, self.conv_in_kernel, self.conv_in_bias)
+        # The input projections of all timesteps in one matrix product; only the recurrent part is sequential
+        z_x = matmul(conv_in.reshape((-1, conv_in.shape[2])), self.lstm_kernel).reshape((batch_size, num_timesteps, -1)) + self.lstm_bias
+        state_h = np.zeros((batch_size, self.num_hidden_dimensions), dtype='float32')
+        state_c = np.zeros((batch_size, self.num_hidden_dimensions), dtype='float32')
+        lstm_out = np.empty((batch_size, num_timesteps, self.num_hidden_dimensions), dtype='float32')
+        for t in range(num_timesteps):
+            state_h, state_c = self.lstm_step(z_x[:, t], state_h, state_c)
+            lstm_out[:, t] = state_h
+        return causal_conv(lstm_out, self.conv_out_kernel, self.conv_out_bias)
+
+# NumPy counterpart of network_utils.LSTMStepper: steps a NumpyLSTMModel forward one block at a time
+class NumpyLSTMStepper:
+    def __init__(self, model):
+        self.model = model
+        self.num_frequency_dimensions = model.num_frequency_dimensions
+        self.num_hidden_dimensions = model.num_hidden_dimensions
+        self.reset()
+
+    # Clears the carried state, as if starting a new sequence
+    def reset(self, batch_size=1):
+        self.prev_x = np.zeros((batch_size, self.num_frequency_dimensions), dtype='float32')
+        self.prev_lstm = np.zeros((batch_size, self.num_hidden_dimensions), dtype='float32')
+        self.state_h = np.zeros((batch_size, self.num_hidden_dimensions), dtype='float32')
+        self.state_c = np.zeros((batch_size, self.num_hidden_dimensions), dtype='float32')
+
+    # Feeds one block of shape (batch_size, num_frequency_dimensions) and returns the prediction for the next one
+    def step(self, x):
+        m = self.model
+        x = np.asarray(x, dtype='float32')
+        conv_in = causal_conv_step(self.prev_x, x, m.conv_in_kernel, m.conv_in_bias)
+        self.state_h, self.state_c = m.lstm_step(matmul(conv_in, m.lstm_kernel) + m.lstm_bias, self.state_h, self.state_c)
+        y = causal_conv_step(self.prev_lstm, self.state_h, m.conv_out_kernel, m.conv_out_bias)
+        self.prev_x = x
+        self.prev_lstm = self.state_h
+        return y
+
+# Loads a model exported with export_weights, or quantized with quantization.quantize_model_file
+def load_numpy_model(filename):
+    weights = np.load(filename)
+    assert int(weights['version']) == NUMPY_MODEL_VERSION
+    if 'quantized' in weights.files:
+        from nn_utils.quantization import load_quantized_weights
+        return NumpyLSTMModel(load_quantized_weights(weights))
+    return NumpyLSTMModel(weights)
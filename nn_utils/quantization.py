@@ -0,0 +1,105 @@
+import time
+import numpy as np
+from nn_utils.numpy_engine import NUMPY_MODEL_VERSION, KERNEL_NAMES, BIAS_NAMES, NumpyLSTMModel, NumpyLSTMStepper, load_numpy_model
+
+# Post-training int8 quantization of the NumPy inference engine's weights.
+# Every weight matrix is stored as int8 with one float32 scale per output channel (symmetric, max-abs calibrated),
+# which makes the model about four times smaller on disk and in memory. NumPy has no int8 matrix product, so the
+# matrices are dequantized a tile of rows at a time while multiplying: only the int8 weights are streamed from memory,
+# and each float32 tile stays in cache. Whether that is faster than the float model depends on the machine's memory
+# bandwidth and the batch size; quantization_report measures both.
+
+# Rows of a QuantizedMatrix dequantized at a time (64 rows of a 4096 wide matrix take 1MB as float32)
+TILE_ROWS = 64
+
+# int8 matrix of shape (num_inputs, num_outputs) with per output channel scales
+class QuantizedMatrix:
+    def __init__(self, values, scale, tile_rows=TILE_ROWS):
+        self.values = values
+        self.scale = scale.astype('float32')
+        self.shape = values.shape
+        self.nbytes = values.nbytes + self.scale.nbytes
+        self.tile_rows = tile_rows
+
+    # x . dequantized matrix, for x of shape (batch, num_inputs)
+    def dot(self, x):
+        out = np.zeros((x.shape[0], self.shape[1]), dtype='float32')
+        for start in range(0, self.shape[0], self.tile_rows):
+            tile = self.values[start:start+self.tile_rows].astype('float32')
+            out += np.dot(x[:, start:start+self.tile_rows], tile)
+        out *= self.scale
+        return out
+
+    def dequantize(self):
+        return self.values.astype('float32') * self.scale
+
+# Symmetric per-column int8 quantization of a (num_inputs, num_outputs) matrix: returns (values, scale)
+def quantize_matrix(matrix):
+    scale = np.max(np.abs(matrix), axis=0) / 127.0
+    scale = np.where(scale > 0, scale, 1.0).astype('float32')
+    values = np.clip(np.round(matrix / scale), -127, 127).astype('int8')
+    return values, scale
+
+# Quantizes a .npz exported with numpy_engine.export_weights. Convolution kernels are quantized one tap at a time.
+def quantize_model_file(filename, out_filename):
+    weights = np.load(filename)
+    arrays = {'version': NUMPY_MODEL_VERSION, 'quantized': True, 'recurrent_activation': weights['recurrent_activation']}
+    for name in BIAS_NAMES:
+        arrays[name] = weights[name]
+    for name in KERNEL_NAMES:
+        kernel = weights[name]
+        if kernel.ndim == 3:
+            taps = [quantize_matrix(kernel[tap]) for tap in range(kernel.shape[0])]
+            arrays[name + '_values'] = np.stack([values for values, scale in taps])
+            arrays[name + '_scale'] = np.stack([scale for values, scale in taps])
+        else:
+            arrays[name + '_values'], arrays[name + '_scale'] = quantize_matrix(kernel)
+    with open(out_filename, 'wb') as f:
+        np.savez(f, **arrays)
+
+# Turns the contents of a quantized .npz into the weights of a NumpyLSTMModel
+def load_quantized_weights(data):
+    weights = {'recurrent_activation': data['recurrent_activation']}
+    for name in BIAS_NAMES:
+        weights[name] = data[name]
+    for name in KERNEL_NAMES:
+        values = data[name + '_values']
+        scale = data[name + '_scale']
+        if values.ndim == 3:
+            weights[name] = [QuantizedMatrix(values[tap], scale[tap]) for tap in range(values.shape[0])]
+        else:
+            weights[name] = QuantizedMatrix(values, scale)
+    return weights
+
+# Log magnitude spectra (in dB) of generated feature blocks, after undoing the dataset normalization
+def output_spectra(outputs, X_var, X_mean, to_time_blocks):
+    features = outputs.reshape((-1, outputs.shape[-1])) * X_var + X_mean
+    magnitudes = np.abs(np.fft.rfft(to_time_blocks(features), axis=1))
+    return 20.0 * np.log10(np.maximum(magnitudes, 1.0e-6))
+
+# Compares a quantized model against the float model it was made from on the given seed sequences.
+# Reports the relative RMS error of the normalized outputs, the error of the output magnitude spectra in dB,
+# the signal-to-noise ratio of the decoded audio blocks, the weight sizes, and the time per block of stepwise generation.
+# to_time_blocks converts (num_blocks, num_dims) un-normalized features to time domain blocks.
+def quantization_report(float_model, quantized_model, seeds, X_var, X_mean, to_time_blocks, num_steps=10):
+    report = {}
+    float_out = float_model.predict(seeds)
+    quantized_out = quantized_model.predict(seeds)
+    report['relative_rms_error'] = float(np.sqrt(np.mean((float_out - quantized_out)**2) / max(np.mean(float_out**2), 1.0e-12)))
+    spectrum_error = np.abs(output_spectra(float_out, X_var, X_mean, to_time_blocks) - output_spectra(quantized_out, X_var, X_mean, to_time_blocks))
+    report['spectrum_error_db_mean'] = float(np.mean(spectrum_error))
+    report['spectrum_error_db_p99'] = float(np.percentile(spectrum_error, 99))
+    float_audio = to_time_blocks(float_out.reshape((-1, float_out.shape[-1])) * X_var + X_mean)
+    quantized_audio = to_time_blocks(quantized_out.reshape((-1, quantized_out.shape[-1])) * X_var + X_mean)
+    noise = np.sum((float_audio - quantized_audio)**2)
+    report['audio_snr_db'] = float(10.0 * np.log10(np.sum(float_audio**2) / max(noise, 1.0e-20)))
+    report['float_bytes'] = int(float_model.nbytes())
+    report['quantized_bytes'] = int(quantized_model.nbytes())
+    for name, model in (('float', float_model), ('quantized', quantized_model)):
+        stepper = NumpyLSTMStepper(model)
+        stepper.reset(seeds.shape[0])
+        start = time.time()
+        for t in range(num_steps):
+            stepper.step(seeds[:, t % seeds.shape[1]])
+        report[name + '_seconds_per_block'] = (time.time() - start) / num_steps
+    return report
@@ -0,0 +1,223 @@
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None # Python 2: --trace-memory falls back to the peak resident set size
+try:
+    import resource
+except ImportError:
+    resource = None # Windows
+
+# Lightweight timers and counters for the hot paths (decoding, FFT, windowing, normalization, disk writes, training
+# phases, generation steps). Timers accumulate call count, total/max time and the number of items (samples, blocks,
+# examples, ...) processed, from which throughput is reported. Timing costs two clock reads per call, so the timers
+# are always on; the summary is printed at the end of a run and can be logged as JSON lines along the way.
+#
+# Scripts call add_arguments(parser) and setup(args) to get --instrument-log, --profile and --trace-memory, and
+# finish() at the end. Library code just wraps work in 'with timer(name, items):' (setting the timer's items inside
+# the block if they're only known there) or calls count(name).
+
+if hasattr(time, 'perf_counter'):
+    clock = time.perf_counter
+else:
+    clock = time.time
+
+# Peak resident set size of this process in bytes, or None where getrusage is missing.
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+
+# Resets the peak resident set size to the current one where the OS allows it (Linux 4.0+). Returns whether it did.
+def reset_peak_rss():
+    if not os.path.isfile('/proc/self/clear_refs'):
+        return False
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        return False
+    return True
+
+class TimerStat:
+    __slots__ = ('count', 'seconds', 'max_seconds', 'items')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.items = 0
+
+    def summary(self):
+        result = {'count': self.count, 'seconds': self.seconds, 'mean_ms': 1000.0 * self.seconds / max(self.count, 1), 'max_ms': 1000.0 * self.max_seconds}
+        if self.items > 0:
+            result['items'] = self.items
+            result['items_per_second'] = self.items / max(self.seconds, 1.0e-9)
+        return result
+
+class Timer:
+    __slots__ = ('instruments', 'name', 'items', 'start')
+
+    def __init__(self, instruments, name, items):
+        self.instruments = instruments
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instruments.record(self.name, clock() - self.start, self.items)
+
+class Instrumentation:
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+        self.log = None
+        self.profiler = None
+        self.profile_filename = None
+        self.tracing_memory = False
+        self.start_rss = None
+        self.start_time = time.time()
+
+    # Context manager timing a block of work on 'items' items
+    def timer(self, name, items=None):
+        return Timer(self, name, items)
+
+    def record(self, name, seconds, items=None):
+        stat = self.timers.get(name)
+        if stat is None:
+            stat = self.timers[name] = TimerStat()
+        stat.count += 1
+        stat.seconds += seconds
+        if seconds > stat.max_seconds:
+            stat.max_seconds = seconds
+        if items is not None:
+            stat.items += int(items)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def reset(self):
+        self.timers = {}
+        self.counters = {}
+
+    def summary(self):
+        return {'timers': dict((name, stat.summary()) for name, stat in self.timers.items()), 'counters': dict(self.counters)}
+
+    def report(self, file=None):
+        file = file or sys.stdout
+        if len(self.timers) == 0 and len(self.counters) == 0:
+            return
+        print('{0:<32} {1:>8} {2:>10} {3:>10} {4:>10} {5:>14}'.format('timer', 'count', 'total s', 'mean ms', 'max ms', 'items/s'), file=file)
+        for name in sorted(self.timers):
+            stat = self.timers[name].summary()
+            throughput = '{0:>14.1f}'.format(stat['items_per_second']) if 'items_per_second' in stat else '{0:>14}'.format('-')
+            print('{0:<32} {1:>8} {2:>10.3f} {3:>10.2f} {4:>10.2f} {5}'.format(name, stat['count'], stat['seconds'], stat['mean_ms'], stat['max_ms'], throughput), file=file)
+        for name in sorted(self.counters):
+            print('{0:<32} {1:>8}'.format(name, self.counters[name]), file=file)
+
+    # Appends JSON lines to filename, one per log_event call
+    def open_log(self, filename):
+        self.log = open(filename, 'a')
+
+    def log_event(self, event, **fields):
+        if self.log is None:
+            return
+        record = {'event': event, 'time': time.time(), 'elapsed': time.time() - self.start_time, 'pid': os.getpid()}
+        record.update(fields)
+        self.log.write(json.dumps(record, sort_keys=True) + '\n')
+        self.log.flush()
+
+    # Logs the current timers and counters, e.g. once per training iteration
+    def log_summary(self, event='summary', **fields):
+        if self.log is not None:
+            fields.update(self.summary())
+            self.log_event(event, **fields)
+
+    # cProfile profiling of the whole run, written to profile_filename (readable with pstats or snakeviz),
+    # and/or memory tracing: tracemalloc under Python 3; under Python 2 only the peak resident set size is reported
+    def start_profiling(self, profile_filename=None, trace_memory=False):
+        if profile_filename is not None:
+            import cProfile
+            self.profile_filename = profile_filename
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        if trace_memory:
+            if tracemalloc is not None:
+                tracemalloc.start()
+                self.tracing_memory = True
+            elif peak_rss_bytes() is not None:
+                reset_peak_rss()
+                self.start_rss = peak_rss_bytes()
+            else:
+                raise RuntimeError('--trace-memory needs either tracemalloc (Python 3) or the resource module')
+
+    def stop_profiling(self, file=None, top=15):
+        file = file or sys.stdout
+        if self.tracing_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            allocations = tracemalloc.take_snapshot().statistics('lineno')[:top]
+            tracemalloc.stop()
+            self.tracing_memory = False
+            print('Peak traced memory: {0:.1f} MB; largest live allocations:'.format(peak / 1.0e6), file=file)
+            for stat in allocations:
+                print('  {0}'.format(stat), file=file)
+            self.log_event('memory', current_bytes=current, peak_bytes=peak, top=[str(stat) for stat in allocations])
+        if self.start_rss is not None:
+            peak = peak_rss_bytes()
+            print('Peak resident set size: {0:.1f} MB ({1:.1f} MB at start; per-allocation figures need Python 3)'.format(peak / 1.0e6, self.start_rss / 1.0e6), file=file)
+            self.log_event('memory', start_rss_bytes=self.start_rss, peak_rss_bytes=peak)
+            self.start_rss = None
+        if self.profiler is not None:
+            import pstats
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile_filename)
+            print('Profile written to {0}; the most expensive calls:'.format(self.profile_filename), file=file)
+            pstats.Stats(self.profiler, stream=file).sort_stats('cumulative').print_stats(top)
+            self.profiler = None
+
+    # Ends the run: stops profiling, logs and prints the summary, and closes the log
+    def finish(self):
+        self.stop_profiling()
+        self.log_summary('finish')
+        self.report()
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+# Process-wide instance used by the functions below
+instruments = Instrumentation()
+
+def timer(name, items=None):
+    return instruments.timer(name, items)
+
+def count(name, n=1):
+    instruments.count(name, n)
+
+def log_event(event, **fields):
+    instruments.log_event(event, **fields)
+
+def log_summary(event='summary', **fields):
+    instruments.log_summary(event, **fields)
+
+def add_arguments(parser):
+    parser.add_argument("--instrument-log", default=None, type=str, help="Append timings and counters as JSON lines to this file.")
+    parser.add_argument("--profile", default=None, type=str, help="Profile the run with cProfile and write the stats to this file.")
+    parser.add_argument("--trace-memory", action='store_true', default=False, help="Trace memory allocations with tracemalloc and report the peak and largest allocations. Under Python 2, only the peak resident set size is reported.")
+
+def setup(args):
+    if args.instrument_log is not None:
+        instruments.open_log(args.instrument_log)
+        instruments.log_event('start', argv=sys.argv)
+    instruments.start_profiling(args.profile, args.trace_memory)
+
+def finish():
+    instruments.finish()
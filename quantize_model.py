@@ -0,0 +1,50 @@
+from __future__ import print_function
+import os
+import json
+import numpy as np
+from nn_utils.numpy_engine import export_weights, load_numpy_model
+from nn_utils.quantization import quantize_model_file, quantization_report
+from data_utils.parse_files import load_dataset_info, features_to_time_block_matrix
+from data_utils.sharded_dataset import load_dataset
+import gen_utils.seed_generator as seed_generator
+import config.nn_config as nn_config
+import argparse
+
+# Quantizes trained generator weights to int8 for generate.py --numpy --quantized, and reports how much the
+# quantized model's output deviates from the float model's
+config = nn_config.get_neural_net_configuration()
+parser = argparse.ArgumentParser(description="Quantize generator weights to int8 and compare the quantized model against the float model.")
+parser.add_argument("--iteration", default=0, type=int, help="Training iteration to quantize the weights of.")
+parser.add_argument("-r", "--run", default=0, type=int, help="Integer id for the run (used for weight files). Defaults to zero.")
+parser.add_argument("--dataset", default='train', type=str, help='The dataset to draw seed sequences for the report from. Defaults to "train".')
+parser.add_argument("--seeds", default=8, type=int, help="Number of seed sequences to compare the models on.")
+parser.add_argument("--report", default=None, type=str, help="Also write the report to this JSON file.")
+args = parser.parse_args()
+
+model_filename = config['model_basename'] + str(args.run) + '_' + str(args.iteration)
+numpy_filename = model_filename + '.npz'
+quantized_filename = model_filename + '.int8.npz'
+if not os.path.isfile(numpy_filename):
+    print('Exporting weights from {0} to {1}'.format(model_filename, numpy_filename))
+    export_weights(model_filename, numpy_filename)
+print('Quantizing weights from {0} to {1}'.format(numpy_filename, quantized_filename))
+quantize_model_file(numpy_filename, quantized_filename)
+print('Size: {0} -> {1} bytes'.format(os.path.getsize(numpy_filename), os.path.getsize(quantized_filename)))
+
+inputFile = config['model_file'] if args.dataset == 'train' else config['gen_file']
+X_train, y_train = load_dataset(inputFile)
+X_mean = np.load(inputFile + '_mean.npy')
+X_var = np.load(inputFile + '_var.npy')
+dataset_info = load_dataset_info(inputFile)
+if dataset_info['useTimeDomain']:
+    to_time_blocks = lambda blocks: blocks
+else:
+    to_time_blocks = lambda blocks: features_to_time_block_matrix(blocks, dataset_info['feature_format'])
+seeds = seed_generator.generate_copy_seed_sequences(seed_length=1, training_data=X_train, count=args.seeds)
+
+report = quantization_report(load_numpy_model(numpy_filename), load_numpy_model(quantized_filename), seeds, X_var, X_mean, to_time_blocks)
+for key in sorted(report):
+    print('{0}: {1}'.format(key, report[key]))
+if args.report is not None:
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
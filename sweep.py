@@ -0,0 +1,233 @@
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import glob
+import signal
+import itertools
+import subprocess
+import multiprocessing
+import numpy as np
+import argparse
+
+# Hyperparameter sweep over train.py: runs trials as parallel training processes on the local machine, stops the ones
+# that fall behind early, and ranks them at the end.
+#
+# The search space is a JSON file mapping train.py flags (without the leading dashes) to their values:
+#   {"hidden-dims": [256, 512, 1024], "optimizer": ["rmsprop", "adam"],
+#    "dropout": {"uniform": [0.1, 0.5]}, "max-batch": {"int": [100, 500]}}
+# By default every combination of the listed values is tried (grid search, lists only). With --random N, N trials are
+# drawn instead: lists are sampled uniformly, {"uniform": [low, high]} and {"log_uniform": [low, high]} as floats and
+# {"int": [low, high]} as integers (inclusive).
+#
+# Each trial gets its own directory under --out holding its weights, loss metrics, log and parameters. Trials train
+# from the same memory-mapped dataset files, so its pages are shared through the page cache rather than loaded per
+# process. Every trial is limited to --threads threads (TensorFlow's and BLAS' pools) and, where the OS supports it,
+# pinned to its own cores, so --workers trials don't fight over the CPUs.
+#
+# Early stopping follows the median stopping rule: once at least --min-trials other trials have reported a loss for
+# the same iteration, a trial whose loss there is worse than their median is stopped. Losses are read from the
+# loss_metrics_iteration-*.npy files train.py writes after every iteration (--metric, falling back to 'loss').
+
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+
+def is_distribution(value):
+    return isinstance(value, dict)
+
+# All combinations of the space's values. Only lists can be enumerated.
+def grid_trials(space):
+    names = sorted(space)
+    for name in names:
+        if is_distribution(space[name]):
+            raise ValueError('{0} is a distribution, which needs --random'.format(name))
+    values = [space[name] if isinstance(space[name], list) else [space[name]] for name in names]
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+def sample_value(value, random):
+    if isinstance(value, list):
+        return value[random.randint(len(value))]
+    if not is_distribution(value):
+        return value
+    if 'uniform' in value:
+        low, high = value['uniform']
+        return float(random.uniform(low, high))
+    if 'log_uniform' in value:
+        low, high = value['log_uniform']
+        return float(np.exp(random.uniform(np.log(low), np.log(high))))
+    if 'int' in value:
+        low, high = value['int']
+        return int(random.randint(low, high + 1))
+    raise ValueError('Unknown distribution {0}'.format(value))
+
+def random_trials(space, count, seed=None):
+    random = np.random.RandomState(seed)
+    return [dict((name, sample_value(space[name], random)) for name in sorted(space)) for i in range(count)]
+
+# Per-iteration loss history of a trial: {iteration: loss}, from the last epoch of each saved iteration
+def read_history(metrics_dir, metric='val_loss'):
+    history = {}
+    for filename in glob.glob(os.path.join(metrics_dir, 'loss_metrics_iteration-*.npy')):
+        iteration = int(os.path.basename(filename)[len('loss_metrics_iteration-'):-len('.npy')])
+        metrics = np.load(filename, allow_pickle=True).item()
+        losses = metrics.get(metric) or metrics.get('loss')
+        if losses:
+            history[iteration] = float(losses[-1])
+    return history
+
+# Median stopping rule: whether a trial's latest loss is worse than the median of the other trials' losses at the same iteration
+def should_stop(history, other_histories, min_trials):
+    if len(history) == 0:
+        return False
+    iteration = max(history)
+    others = [other[iteration] for other in other_histories if iteration in other]
+    if len(others) < min_trials:
+        return False
+    return history[iteration] > np.median(others)
+
+class Trial:
+    def __init__(self, number, params, directory):
+        self.number = number
+        self.params = params
+        self.directory = directory
+        self.process = None
+        self.log = None
+        self.status = 'pending'
+        self.history = {}
+        self.start_time = None
+        self.seconds = 0.0
+
+    def command(self, train_args, threads):
+        command = [sys.executable, 'train.py'] + train_args
+        # After train_args, so the trial's settings win
+        command += ['--model-basename', os.path.join(self.directory, 'weights_'), '--metrics-dir', self.directory, '--threads', str(threads)]
+        for name in sorted(self.params):
+            command += ['--' + name, str(self.params[name])]
+        return command
+
+    def start(self, train_args, threads, cores=None):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        with open(os.path.join(self.directory, 'params.json'), 'w') as f:
+            json.dump(self.params, f, indent=2, sort_keys=True)
+        env = dict(os.environ)
+        for name in THREAD_ENV_VARS:
+            env[name] = str(threads)
+        preexec_fn = None
+        if cores is not None and hasattr(os, 'sched_setaffinity'):
+            preexec_fn = lambda: os.sched_setaffinity(0, cores)
+        self.log = open(os.path.join(self.directory, 'train.log'), 'w')
+        self.process = subprocess.Popen(self.command(train_args, threads), stdout=self.log, stderr=subprocess.STDOUT, env=env, preexec_fn=preexec_fn)
+        self.status = 'running'
+        self.start_time = time.time()
+
+    def update_history(self, metric):
+        try:
+            self.history = read_history(self.directory, metric)
+        except (IOError, ValueError):
+            pass # Written by a train.py from before metrics were saved atomically; try again next time
+
+    # Returns True once the process has exited
+    def poll(self):
+        if self.process.poll() is None:
+            return False
+        self.finish('completed' if self.process.returncode == 0 else 'failed')
+        return True
+
+    def stop(self):
+        self.process.send_signal(signal.SIGTERM)
+        self.process.wait()
+        self.finish('stopped')
+
+    def finish(self, status):
+        self.status = status
+        self.seconds = time.time() - self.start_time
+        self.log.close()
+
+    def best_loss(self):
+        return min(self.history.values()) if self.history else None
+
+    def summary(self):
+        return {'trial': self.number, 'params': self.params, 'status': self.status, 'best_loss': self.best_loss(),
+                'iterations': max(self.history) if self.history else 0, 'seconds': self.seconds, 'directory': self.directory}
+
+# Runs the trials, at most num_workers at a time, and returns them once all have finished or been stopped.
+# Worker slot i is pinned to the i-th group of 'threads' of the cores this process may use, if there are enough for all slots.
+def run_sweep(trials, train_args, num_workers, threads, metric='val_loss', min_trials=3, poll_interval=5.0):
+    pending = list(trials)
+    running = {}
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(multiprocessing.cpu_count()))
+    pin = num_workers * threads <= len(cpus)
+    try:
+        while pending or running:
+            free_slots = [slot for slot in range(num_workers) if slot not in running]
+            while pending and free_slots:
+                slot = free_slots.pop(0)
+                trial = pending.pop(0)
+                cores = set(cpus[slot * threads:(slot + 1) * threads]) if pin else None
+                trial.start(train_args, threads, cores)
+                running[slot] = trial
+                print('Started trial {0} {1}'.format(trial.number, json.dumps(trial.params, sort_keys=True)))
+            time.sleep(poll_interval)
+            for trial in trials:
+                if trial.status != 'pending':
+                    trial.update_history(metric)
+            for slot, trial in list(running.items()):
+                if trial.poll():
+                    del running[slot]
+                    print('Trial {0} {1} (best loss {2})'.format(trial.number, trial.status, trial.best_loss()))
+                elif should_stop(trial.history, [other.history for other in trials if other is not trial], min_trials):
+                    trial.stop()
+                    del running[slot]
+                    print('Stopped trial {0} at iteration {1}: loss {2:.5f} is worse than the median'.format(trial.number, max(trial.history), trial.history[max(trial.history)]))
+    finally:
+        for trial in running.values():
+            trial.stop()
+    return trials
+
+def print_summary(trials):
+    ranked = sorted(trials, key=lambda trial: (trial.best_loss() is None, trial.best_loss() or 0.0))
+    print('{0:>5} {1:>6} {2:>10} {3:>11} {4:>10}  {5}'.format('rank', 'trial', 'best loss', 'iterations', 'status', 'parameters'))
+    for rank, trial in enumerate(ranked):
+        summary = trial.summary()
+        best_loss = '-' if summary['best_loss'] is None else '{0:.5f}'.format(summary['best_loss'])
+        print('{0:>5} {1:>6} {2:>10} {3:>11} {4:>10}  {5}'.format(rank + 1, trial.number, best_loss, summary['iterations'], trial.status, json.dumps(trial.params, sort_keys=True)))
+    return ranked
+
+def __main__():
+    parser = argparse.ArgumentParser(description="Run a hyperparameter sweep over train.py on the local machine.",
+                                     epilog="Arguments after -- are passed to every trial's train.py, e.g. -- --iterations 20 --epochs 5 --stream")
+    parser.add_argument("space", type=str, help="JSON file with the search space (see sweep.py).")
+    parser.add_argument("--random", default=0, type=int, help="Number of random trials to draw from the space. Defaults to a full grid search.")
+    parser.add_argument("--seed", default=None, type=int, help="Random seed for --random.")
+    parser.add_argument("--out", default='sweep', type=str, help="Directory for the trials' weights, metrics and logs, and the summary.")
+    parser.add_argument("--threads", default=1, type=int, help="Number of threads per trial.")
+    parser.add_argument("--workers", default=0, type=int, help="Number of trials run at once. Defaults to the number of cores divided by --threads.")
+    parser.add_argument("--metric", default='val_loss', type=str, help="Metric to rank and stop trials by (lower is better). Falls back to 'loss' for trials without it.")
+    parser.add_argument("--min-trials", default=3, type=int, help="Number of other trials that must have reached an iteration before a trial can be stopped there.")
+    parser.add_argument("--poll", default=5.0, type=float, help="Seconds between checks of the trials' progress.")
+    argv = sys.argv[1:]
+    train_args = []
+    if '--' in argv:
+        train_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+
+    with open(args.space) as f:
+        space = json.load(f)
+    params = random_trials(space, args.random, args.seed) if args.random > 0 else grid_trials(space)
+    num_workers = args.workers if args.workers > 0 else max(multiprocessing.cpu_count() // args.threads, 1)
+    trials = [Trial(i, trial_params, os.path.join(args.out, 'trial_{0:03d}'.format(i))) for i, trial_params in enumerate(params)]
+    print('Running {0} trials, {1} at a time with {2} thread(s) each'.format(len(trials), num_workers, args.threads))
+
+    run_sweep(trials, train_args, num_workers, args.threads, args.metric, args.min_trials, args.poll)
+    ranked = print_summary(trials)
+    with open(os.path.join(args.out, 'summary.json'), 'w') as f:
+        json.dump([trial.summary() for trial in ranked], f, indent=2, sort_keys=True)
+    print('Summary written to {0}'.format(os.path.join(args.out, 'summary.json')))
+
+if __name__ == '__main__':
+    __main__()
@@ -2,63 +2,97 @@ from __future__ import absolute_import
 from __future__ import print_function
 import numpy as np
 import os
-import nn_utils.network_utils as network_utils
+from nn_utils.checkpoints import CheckpointManager, atomic_write
 import config.nn_config as nn_config
-import tensorflow as tf
+import perf_utils.instrumentation as instrumentation
+from data_utils.parse_files import load_dataset_info, feature_dimensions
+from data_utils.sharded_dataset import load_dataset, load_sequence_dataset
+from data_utils.batch_loader import BatchLoader, BucketBatchLoader
 import argparse
 
+config = nn_config.get_neural_net_configuration()
+
+def save_metrics_file(filename, metrics):
+    with open(filename, 'wb') as f:
+        np.save(f, metrics)
+
 parser = argparse.ArgumentParser(description="Train the NuGRUV generator network against the current dataset.")
-parser.add_argument("current_iteration", default=0, type=int, help="Current training iteration to start from.")
+parser.add_argument("current_iteration", nargs='?', default=0, type=int, help="Current training iteration to start from.")
 parser.add_argument("-i", "--iterations", default=50, type=int, help="Total number of iterations to perform.")
 parser.add_argument("-e", "--epochs", default=25, type=int, help="Number of epochs per iteration.")
 parser.add_argument("-b", "--max-batch", default=500, type=int, help="Maximum number of training examples to batch per gradient update.")
 parser.add_argument("-v", "--validation", default=True, type=bool, help="Use cross validation data.")
 parser.add_argument("-n", "--interval", default=5, type=int, help="Number of iterations to run in between retaining saved weights.")
+parser.add_argument("--keep-last", default=2, type=int, help="Number of most recent saved weights to retain in addition to those retained every --interval iterations.")
+parser.add_argument("--resume", action='store_true', default=False, help="Resume from the most recent complete saved weights instead of current_iteration.")
 parser.add_argument("-o", "--optimizer", default="rmsprop", type=str, help="Name of the optimizer to use for the generative model. Defaults to 'rmsprop'")
 parser.add_argument("-d", "--dropout", default=0.3, type=float, help="Probability of dropout applied to the first layer of the generative network.")
+parser.add_argument("--hidden-dims", default=config['hidden_dimension_size'], type=int, help="Number of hidden layer dimensions.")
+parser.add_argument("--model-basename", default=config['model_basename'], type=str, help="Prefix of the saved weights files. Defaults to the configured model_basename.")
+parser.add_argument("--metrics-dir", default='.', type=str, help="Directory to save the per-iteration loss_metrics_iteration-*.npy files to.")
+parser.add_argument("--threads", default=0, type=int, help="Number of threads TensorFlow may use per operation, e.g. when several trainings share a machine (see sweep.py). Defaults to TensorFlow's choice.")
+parser.add_argument("--log-device-placement", action='store_true', default=False, help="Log the device (CPU/GPU) every TensorFlow operation runs on.")
+parser.add_argument("--stream", action='store_true', default=False, help="Stream shuffled mini-batches from disk with background prefetching instead of handing the whole dataset to Keras. Use this for datasets larger than RAM.")
+parser.add_argument("--bucketed", action='store_true', default=False, help="Train on variable-length sequences (whole songs by default) batched by similar length, instead of fixed-length windows. Requires a dataset converted with --sharded --blocks.")
+parser.add_argument("--max-sequence-len", default=0, type=int, help="With --bucketed, cut songs into sequences of at most this many blocks. Defaults to whole songs.")
+parser.add_argument("--max-padding", default=0.1, type=float, help="With --bucketed, maximum fraction of a batch's timesteps that may be padding.")
+parser.add_argument("--prefetch-workers", default=2, type=int, help="Number of threads assembling batches ahead of training when streaming.")
+parser.add_argument("--prefetch-batches", default=4, type=int, help="Maximum number of batches prepared ahead of training when streaming.")
+instrumentation.add_arguments(parser)
 args = parser.parse_args()
+instrumentation.setup(args)
 
-sess = tf.Session(config=tf.ConfigProto(log_device_placement=True))
+#Keras/TensorFlow are only loaded once the arguments are known to be fine, so --help and argument errors return at once
+import nn_utils.network_utils as network_utils
+network_utils.configure_session(args.threads, args.log_device_placement)
 
-config = nn_config.get_neural_net_configuration()
 inputFile = config['model_file']
 cur_iter = args.current_iteration
-model_basename = config['model_basename']
-model_filename = model_basename + str(cur_iter)
+model_basename = args.model_basename
 use_validation = args.validation
 
 #Load up the training data
 print ('Loading training data')
 #X_train is a tensor of size (num_train_examples, num_timesteps, num_frequency_dims)
 #y_train is a tensor of size (num_train_examples, num_timesteps, num_frequency_dims)
-X_train = np.load(inputFile + '_x.npy')
-y_train = np.load(inputFile + '_y.npy')
+#Both are memory-mapped (or lazily loaded from shards), so examples are only read from disk as they are used
+X_train, y_train = load_dataset(inputFile)
 if use_validation:
-    X_val = np.load(inputFile + '_val_x.npy')
-    y_val = np.load(inputFile + '_val_y.npy')
+    X_val, y_val = load_dataset(inputFile, split='val')
 print ('Finished loading training data')
 
 #Figure out how many frequencies we have in the data
 num_timesteps = X_train.shape[1]
 freq_space_dims = X_train.shape[2]
-hidden_dims = config['hidden_dimension_size']
+dataset_info = load_dataset_info(inputFile)
+if 'block_size' in dataset_info and not dataset_info['useTimeDomain']:
+    assert freq_space_dims == feature_dimensions(dataset_info['block_size'], dataset_info['feature_format'])
+print('Feature format: {0} ({1} frequency dimensions)'.format(dataset_info['feature_format'], freq_space_dims))
+hidden_dims = args.hidden_dims
 recurrent_units = config['hidden_recurrent_layers']
 
 #Creates a lstm network
 print('Initializing network...')
-model = network_utils.create_lstm_network(num_frequency_dimensions=freq_space_dims, num_hidden_dimensions=hidden_dims, optimizer=args.optimizer, dropout_rate=args.dropout)
+model = network_utils.create_lstm_network(num_frequency_dimensions=freq_space_dims, num_hidden_dimensions=hidden_dims, optimizer=args.optimizer, dropout_rate=args.dropout, sample_weight_mode='temporal' if args.bucketed else None)
 #You could also substitute this with a RNN or GRU
 #model = network_utils.create_gru_network()
 
 print('Model summary:')
 model.summary()
 
+#Weights (and optimizer state) are saved in the background, keeping the last few plus one every 'interval' saves.
+#Saves are numbered by epoch count, so every 'interval' saves is every interval * epochs iterations.
+checkpoints = CheckpointManager([(model_basename, model)], keep_last=args.keep_last, keep_every=args.interval * args.epochs)
+if args.resume:
+    latest = checkpoints.latest()
+    if latest is not None:
+        cur_iter = latest
+
 #Load existing weights if available
-if os.path.isfile(model_filename):
-    print ('Loading existing weight data from {}'.format(model_filename))
-    model.load_weights(model_filename)
+if checkpoints.is_complete(cur_iter):
+    checkpoints.restore(cur_iter)
 
-num_iters = cur_iter + args.num_iterations 		#Number of iterations for training
+num_iters = cur_iter + args.iterations 		#Number of iterations for training
 epochs_per_iter = args.epochs	                #Number of iterations before we save our model
 batch_size = X_train.shape[0]
 while batch_size > args.max_batch:
@@ -96,22 +130,49 @@ if use_validation:
     print('Validation set shape: {0}'.format(X_val.shape))
     val_data = (X_val, y_val)
 
+use_generator = args.stream or args.bucketed
+if args.bucketed:
+    #Variable-length sequences grouped into batches of similar length, holding at most as many timesteps as a batch of windows
+    max_len = args.max_sequence_len if args.max_sequence_len > 0 else None
+    train_loader = BucketBatchLoader(load_sequence_dataset(inputFile, max_len=max_len), batch_size, max_padding=args.max_padding, max_timesteps=batch_size*num_timesteps, shuffle=True)
+    print('Bucketed {0} training sequences into {1} batches ({2:.1%} padding)'.format(len(train_loader.dataset), len(train_loader), train_loader.padding_fraction()))
+    if use_validation:
+        val_loader = BucketBatchLoader(load_sequence_dataset(inputFile, split='val', max_len=max_len), batch_size, max_padding=args.max_padding, max_timesteps=batch_size*num_timesteps, shuffle=False)
+elif args.stream:
+    #Batches are read from the memory-mapped dataset and assembled by background threads while the model trains
+    train_loader = BatchLoader(X_train, y_train, batch_size, shuffle=True)
+    if use_validation:
+        val_loader = BatchLoader(X_val, y_val, batch_size, shuffle=False)
+if use_generator:
+    #The loaders shuffle themselves, and Keras calls their on_epoch_end after each of its epochs, across every fit_generator call
+    train_batches = network_utils.LoaderSequence(train_loader)
+    val_batches = None
+    val_steps = None
+    if use_validation and len(val_loader) > 0:
+        val_batches = network_utils.LoaderSequence(val_loader)
+        val_steps = len(val_loader)
+
 print ('Starting training!')
-last_interval = 0
 while cur_iter < num_iters:
     print('Iteration: ' + str(cur_iter))
-    history = model.fit(X_train, y_train, batch_size=batch_size, epochs=epochs_per_iter, shuffle=True, verbose=1, validation_data=val_data)
+    #Throughput is in training sequences (windows, or bucketed songs) per second
+    with instrumentation.timer('train.fit', items=(len(train_loader.dataset) if args.bucketed else X_train.shape[0]) * epochs_per_iter):
+        if use_generator:
+            history = model.fit_generator(train_batches, steps_per_epoch=len(train_loader), epochs=epochs_per_iter, verbose=1, validation_data=val_batches, validation_steps=val_steps,
+                                          workers=args.prefetch_workers, max_queue_size=args.prefetch_batches, use_multiprocessing=False, shuffle=False)
+        else:
+            history = model.fit(X_train, y_train, batch_size=batch_size, epochs=epochs_per_iter, shuffle=True, verbose=1, validation_data=val_data)
     save_metrics = history.history
     
-    if cur_iter - last_interval < args.interval and os.path.isfile(model_basename + str(cur_iter)):
-        os.remove(model_basename + str(cur_iter))
-    else:
-        last_interval = cur_iter
-        
     cur_iter += epochs_per_iter
     
     print ('Saving weights for iteration {0} ...'.format(cur_iter))
-    model.save_weights(model_basename + str(cur_iter))
-    np.save('loss_metrics_iteration-%d.npy' % cur_iter, save_metrics)
+    checkpoints.save(cur_iter)
+    #Written atomically, since sweep.py reads them while training runs
+    atomic_write(os.path.join(args.metrics_dir, 'loss_metrics_iteration-%d.npy' % cur_iter), save_metrics_file, save_metrics)
+    instrumentation.log_summary('iteration', iteration=cur_iter, loss=float(save_metrics['loss'][-1]))
     
+with instrumentation.timer('train.checkpoint_wait'):
+    checkpoints.wait()
 print ('Training complete!')
+instrumentation.finish()
@@ -3,11 +3,15 @@ from __future__ import print_function
 from generate import generate
 import numpy as np
 import os
-import nn_utils.network_utils as network_utils
+from nn_utils.checkpoints import CheckpointManager
 import config.nn_config as nn_config
+import perf_utils.instrumentation as instrumentation
+from data_utils.parse_files import load_dataset_info, feature_dimensions, split_indices
+from data_utils.batch_loader import BatchLoader
+from data_utils.sharded_dataset import load_dataset
 import gen_utils.seed_generator as seed_generator
 import gen_utils.sequence_generator as sequence_generator
-import tensorflow as tf
+from gen_utils.replay_buffer import ReplayBuffer, EVICTION_POLICIES
 import argparse
 
 # Default maximum batch size for 'auto' batching
@@ -22,36 +26,44 @@ parser.add_argument("--dec-epochs", default=50, type=int, help="Number of epochs
 parser.add_argument("--gen-epochs", default=25, type=int, help="Number of epochs per iteration of the generator.")
 parser.add_argument("--com-epochs", default=1, type=int, help="Number of epochs per iteration to train the combined GAN model.")
 parser.add_argument("--dec-samples", default=10, type=int, help="Number of decoder samples to use.")
+parser.add_argument("--replay-size", default=MAX_DECODER_EXAMPLES, type=int, help="Number of previously generated fake examples kept for training the decoder. 0 generates every fake example afresh.")
+parser.add_argument("--replay-refresh", default=0.5, type=float, help="Fraction of each decoder iteration's fake examples that are freshly generated; the rest are drawn from earlier iterations.")
+parser.add_argument("--replay-eviction", default='fifo', choices=EVICTION_POLICIES, help="Which stored fake examples to replace once the replay buffer is full.")
 parser.add_argument("-b", "--max-batch", default=500, type=int, help="Maximum number of training examples to batch per gradient update.")
 parser.add_argument("--skip-validation", action="store_true", help="Do not use cross validation data.")
 parser.add_argument("-n", "--interval", default=10, type=int, help="Number of iterations to run in between retaining saved weights.")
+parser.add_argument("--keep-last", default=2, type=int, help="Number of most recent saved weights to retain in addition to those retained every --interval iterations.")
+parser.add_argument("--resume", action='store_true', default=False, help="Resume from the most recent complete saved weights instead of current_iteration.")
 parser.add_argument("-o", "--optimizer", default="rmsprop", type=str, help="Name of the optimizer to use for the generative model. Defaults to 'rmsprop'")
 parser.add_argument("-d", "--dropout", default=0.3, type=float, help="Probability of dropout applied to the first layer of the generative network.")
 parser.add_argument("-r", "--run", default=0, type=int, help="Integer id for this run (used for weight files). Defaults to zero.")
 parser.add_argument("--hidden-dims", default=config['hidden_dimension_size'], type=int, help="Number of hidden layer dimensions.")
+parser.add_argument("--log-device-placement", action='store_true', default=False, help="Log the device (CPU/GPU) every TensorFlow operation runs on.")
+instrumentation.add_arguments(parser)
 args = parser.parse_args()
+instrumentation.setup(args)
 
-sess = tf.Session(config=tf.ConfigProto(log_device_placement=True))
+#Keras/TensorFlow are only loaded once the arguments are known to be fine, so --help and argument errors return at once
+import nn_utils.network_utils as network_utils
+network_utils.configure_session(log_device_placement=args.log_device_placement)
 
 inputFile = config['model_file']
 cur_iter = args.current_iteration
 dec_basename = config['model_basename'] + str(args.run) + '-Dec_'
-dec_filename = dec_basename + str(cur_iter)
 gen_basename = config['model_basename'] + str(args.run) + '_'
-gen_filename = gen_basename + str(cur_iter)
+gan_basename = config['model_basename'] + str(args.run) + '-GAN_'
 skip_validation = args.skip_validation
 
 #Load up the training data
 print('Loading training data')
 #X_train is a tensor of size (num_train_examples, num_timesteps, num_frequency_dims)
 #y_train is a tensor of size (num_train_examples, num_timesteps, num_frequency_dims)
-X_train = np.load(inputFile + '_x.npy')
-y_train = np.load(inputFile + '_y.npy')
+#Both are memory-mapped (or lazily loaded from shards), so examples are only read from disk as they are used
+X_train, y_train = load_dataset(inputFile)
 print(X_train.shape)
 print(y_train.shape)
 if not skip_validation:
-    X_val = np.load(inputFile + '_val_x.npy')
-    y_val = np.load(inputFile + '_val_y.npy')
+    X_val, y_val = load_dataset(inputFile, split='val')
     print(X_val.shape)
     print(y_val.shape)
 print('Finished loading training data')
@@ -59,6 +71,10 @@ print('Finished loading training data')
 #Figure out how many frequencies we have in the data
 num_timesteps = X_train.shape[1]
 freq_space_dims = X_train.shape[2]
+dataset_info = load_dataset_info(inputFile)
+if 'block_size' in dataset_info and not dataset_info['useTimeDomain']:
+    assert freq_space_dims == feature_dimensions(dataset_info['block_size'], dataset_info['feature_format'])
+print('Feature format: {0} ({1} frequency dimensions)'.format(dataset_info['feature_format'], freq_space_dims))
 hidden_dims = args.hidden_dims
 
 #Creates a Genearative Adverserial Network (GAN) using the normal NuGRUV LSTM network as the generator.
@@ -68,13 +84,18 @@ gan = network_utils.create_gan(num_frequency_dimensions=freq_space_dims, num_hid
 print('Model summary:')
 gan.summary()
 
+#Generator and decoder weights (and optimizer state) are saved together in the background, keeping the last few plus one every 'interval' iterations.
+#The combined model shares their weights but has its own optimizer, whose decayed learning rate depends on its iteration count, so its state is saved too.
+checkpoints = CheckpointManager([(gen_basename, gan.generator), (dec_basename, gan.decoder)], keep_last=args.keep_last, keep_every=args.interval,
+                                optimizer_members=[(gan_basename, gan.model)])
+if args.resume:
+    latest = checkpoints.latest()
+    if latest is not None:
+        cur_iter = latest
+
 #Load existing weights if available
-if os.path.isfile(dec_filename):
-    print('Loading existing weight data (Decoder) from {}'.format(dec_filename))
-    gan.decoder.load_weights(dec_filename)
-if os.path.isfile(gen_filename):
-    print('Loading existing weight data (Generator) from {}'.format(gen_filename))
-    gan.generator.load_weights(gen_filename)
+if checkpoints.is_complete(cur_iter):
+    checkpoints.restore(cur_iter)
 
 batch_size = X_train.shape[0]
 while batch_size > args.max_batch:
@@ -112,23 +133,33 @@ if not skip_validation:
     print('Validation set shape: {0}'.format(X_val.shape))
     val_data = (X_val, y_val)
 
-def random_training_examples(X_train, seed_len=1, count=1):
-    examples = np.zeros((0,X_train.shape[1]*seed_len,X_train.shape[2]))
-    for i in xrange(count):
-        next_example = seed_generator.generate_copy_seed_sequence(seed_length=seed_len, training_data=X_train)
-        examples = np.concatenate((examples, next_example), axis=0)
-    return examples
+#The combined model holds out a quarter of the training examples for validation, picked the same way as the converters'
+#validation split. Its batches are read as they are trained on, so (sharded or memory-mapped) data is never loaded whole.
+com_train_indices, com_val_indices = split_indices(X_train.shape[0], 0.25)
+com_loader = BatchLoader(X_train, None, batch_size, shuffle=True, indices=com_train_indices)
+com_val_loader = BatchLoader(X_train, None, batch_size, shuffle=False, indices=com_val_indices)
+
+#Fake examples generated in earlier iterations, re-used for part of each decoder training set
+fake_buffer = ReplayBuffer(args.replay_size, refresh_fraction=args.replay_refresh, eviction=args.replay_eviction)
 
 def train_decoder(X_train, sample_size):
     print('Training decoder...')
-    X_real = random_training_examples(X_train, seed_len=1, count=sample_size)
+    X_real = seed_generator.generate_copy_seed_sequences(seed_length=1, training_data=X_train, count=sample_size)
     print(X_real.shape)
     # Generate fake examples from random seeds. To make sure we train the decoder on the same input it will receive from the generator
     # in the combined model, we need to cap the sequence length at 'num_timesteps' (note: this means only the model's reproduction of the seed sequence + 1 num_timesteps
     # will be included in the output; room for further improvement)
-    X_fake = generate(gan.generator, X_train, max_seq_len=num_timesteps, gen_count=sample_size, include_raw_seed=False, include_model_seed=True, uncenter_data=False)
+    # Only part of the fakes are generated afresh; fit_decoder tops them up from the replay buffer
+    num_fresh = fake_buffer.num_fresh(sample_size)
+    print('Generating {0} fake examples ({1} from the replay buffer)'.format(num_fresh, sample_size - num_fresh))
+    if num_fresh > 0:
+        with instrumentation.timer('gan.generate_fakes', items=num_fresh):
+            X_fake = generate(gan.generator, X_train, max_seq_len=num_timesteps, gen_count=num_fresh, include_raw_seed=False, include_model_seed=True, uncenter_data=False)
+    else:
+        X_fake = np.zeros((0,) + X_real.shape[1:], dtype=X_real.dtype)
     print(X_fake.shape)
-    dec_hist = gan.fit_decoder(X_real, X_fake, epochs=args.dec_epochs, shuffle=True, verbose=1, validation_split=0.25)
+    with instrumentation.timer('gan.fit_decoder', items=2 * sample_size * args.dec_epochs):
+        dec_hist = gan.fit_decoder(X_real, X_fake, epochs=args.dec_epochs, shuffle=True, verbose=1, validation_split=0.25, replay_buffer=fake_buffer)
     
 # Training phase 1: Generator pre-training
 print('Starting training...')
@@ -141,27 +172,20 @@ while cur_iter < num_iters:
     # Start training iteration for each model
     print('Iteration: {0}'.format(cur_iter))
     print('Training generator for {0} epochs (batch size: {1})'.format(args.gen_epochs, batch_size))
-    gen_hist = gan.fit_generator(X_train, y_train, batch_size=batch_size, epochs=args.gen_epochs, shuffle=True, verbose=1, validation_data=val_data)
-    print('Saving generator weights (pre-train) for iteration {0} ...'.format(cur_iter))
-    gan.generator.save_weights(gen_basename + str(cur_iter))
+    with instrumentation.timer('gan.fit_generator', items=X_train.shape[0] * args.gen_epochs):
+        gen_hist = gan.fit_generator(X_train, y_train, batch_size=batch_size, epochs=args.gen_epochs, shuffle=True, verbose=1, validation_data=val_data)
     print('Training decoder for {0} epochs with {1} training examples'.format(args.dec_epochs, decoder_data_len))
     dec_hist = train_decoder(X_train, decoder_data_len)
-    print('Saving decoder weights for iteration {0} ...'.format(cur_iter))
-    gan.decoder.save_weights(dec_basename + str(cur_iter))
     print('Training combined model for {0} epochs'.format(args.com_epochs))
-    gan.fit(X_train, batch_size=batch_size, epochs=args.com_epochs, shuffle=True, verbose=1, validation_split=0.25)
-    print('Saving generator weights (post-train) for iteration {0} ...'.format(cur_iter))
-    gan.generator.save_weights(gen_basename + str(cur_iter))
-    
-    # Clean weights from last iteration, if between persistent save intervals
-    last_iter = cur_iter - 1
-    if last_iter >= 0 and last_iter % args.interval != 0:
-        if os.path.isfile(gen_basename + str(last_iter)):
-            os.remove(gen_basename + str(last_iter))
-        if os.path.isfile(dec_basename + str(last_iter)):
-            os.remove(dec_basename + str(last_iter))
+    with instrumentation.timer('gan.fit_combined', items=X_train.shape[0] * args.com_epochs):
+        gan.fit_loader(com_loader, epochs=args.com_epochs, verbose=1, val_loader=com_val_loader)
+    print('Saving generator and decoder weights for iteration {0} ...'.format(cur_iter))
+    checkpoints.save(cur_iter)
+    instrumentation.log_summary('iteration', iteration=cur_iter)
             
     cur_iter += 1
     
+checkpoints.wait()
 print('Training complete!')
+instrumentation.finish()
 